@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+"""
+Crash-safe session checkpoints for task_code.py
+
+The checkpoint is a small json file next to the data files. It records the
+study info, the plan the session runs (path, seed, and stem order), and how
+far the session got. It is rewritten after every trial and every scan block.
+Each write goes to a temporary file in the same directory that is then moved
+over the old checkpoint with os.replace, so a crash leaves either the old or
+the new checkpoint and never a partial one.
+
+Data rows are written at the end of each scan block, so a session is resumed
+at the trigger wait of the first scan that did not finish.
+"""
+
+# Load libraries
+import json
+import os
+import tempfile
+import time
+
+CHECKPOINT_VERSION = 1
+
+
+def write_checkpoint(path, state, sync=False):
+    """
+    Atomically replaces the checkpoint at path with state
+
+    Parameters
+    ----------
+    path : str
+       Checkpoint file
+    state : dict
+       Json serializable checkpoint contents
+    sync : bool
+       Flush the new file to disk before replacing the old one. Needed to
+       survive power loss, not just a crash of the task.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=".ckpt_", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as fid:
+            json.dump(state, fid)
+            if sync is True:
+                fid.flush()
+                os.fsync(fid.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class Checkpoint:
+    """
+    Progress of a running session
+
+    Parameters
+    ----------
+    path : str
+       Checkpoint file
+    state : dict
+       Checkpoint contents, see create
+    """
+
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+
+    @classmethod
+    def create(cls, path, session):
+        """
+        Writes the first checkpoint of a session that has a plan
+        """
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "info": session.info_dic,
+            "out_root": session.out_root,
+            "plan": os.path.abspath(session.plan_path),
+            "seed": session.seed,
+            "stems": [str(stem) for stem in session.stem_list],
+            "n_scan": session.n_scan,
+            "n_scan_done": 0,
+            "next_trial": 0,
+            "n_resp_total": 0,
+            "scan": None,
+            "trial_idx": 0,
+            "complete": False,
+            "updated": time.time(),
+        }
+        ckpt = cls(path, state)
+        ckpt.write(sync=True)
+        return ckpt
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a checkpoint file
+        """
+        with open(path) as fid:
+            state = json.load(fid)
+        if state.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"{path} is not a version {CHECKPOINT_VERSION} checkpoint")
+        return cls(path, state)
+
+    def trial_done(self, scan, trial_idx):
+        """
+        Records that trials before trial_idx have run. Not synced to disk so
+        it stays cheap enough to call between trials.
+        """
+        self.state["scan"] = scan
+        self.state["trial_idx"] = trial_idx
+        self.write()
+
+    def scan_done(self, n_scan_done, trial_idx, n_resp_total):
+        """
+        Records that the first n_scan_done scans have been run and saved
+        """
+        self.state["n_scan_done"] = n_scan_done
+        self.state["next_trial"] = trial_idx
+        self.state["n_resp_total"] = n_resp_total
+        self.state["scan"] = None
+        self.state["trial_idx"] = trial_idx
+        self.state["complete"] = n_scan_done == self.state["n_scan"]
+        self.write(sync=True)
+
+    def check_plan(self, session):
+        """
+        Makes sure the session's plan is the one the checkpoint was made with
+        """
+        stems = [str(stem) for stem in session.stem_list]
+        if session.seed != self.state["seed"] or stems != self.state["stems"]:
+            raise ValueError(
+                f"Plan {session.plan_path} does not match checkpoint {self.path}"
+            )
+
+    def write(self, sync=False):
+        self.state["updated"] = time.time()
+        write_checkpoint(self.path, self.state, sync=sync)
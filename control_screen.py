@@ -0,0 +1,258 @@
+#!/usr/bin/python
+
+"""
+Control-room (experimenter) screen for task_code.py
+
+The task sends small state messages instead of drawing on the second window
+itself. InlineControl renders them immediately on a window owned by the task
+process, which is how the task has always worked. ControlProcess moves the
+window to a separate process that renders at a limited rate and forwards any
+key presses back, so flips of the participant's window never wait on the
+experimenter display.
+"""
+
+# Load libraries
+import multiprocessing as mp
+import queue
+import time
+from types import SimpleNamespace
+
+
+def make_control_stimuli(visual, win_2, params):
+    """
+    Creates the text stimuli shown on the control screen
+    """
+    start_text = visual.TextStim(
+        win_2,
+        pos=(0, 0),
+        color="Blue",
+        text="Start Scan",
+        units=params["units"],
+        height=params["font_size"]["default"],
+        wrapWidth=params["wrap_width"],
+    )
+    inst_2_text = visual.TextStim(
+        win_2,
+        pos=(0, 0),
+        color="White",
+        text="",
+        units=params["units"],
+        wrapWidth=params["wrap_width"],
+        height=params["font_size"]["default"],
+    )
+    cont_text = visual.TextStim(
+        win_2,
+        pos=(0, -4.5),
+        color="Blue",
+        text="Press space to continue",
+        units=params["units"],
+        height=params["font_size"]["default"],
+        wrapWidth=params["wrap_width"],
+    )
+    update_text = visual.TextStim(
+        win_2,
+        pos=(0, 0),
+        color="Blue",
+        text="",
+        units=params["units"],
+        height=params["font_size"]["update"],
+        wrapWidth=params["wrap_width"],
+    )
+    return SimpleNamespace(
+        start_text=start_text,
+        inst_2_text=inst_2_text,
+        cont_text=cont_text,
+        update_text=update_text,
+    )
+
+
+# Function to create progress text
+def format_progress(
+    scan, n_scan, trial_idx, n_trial, n_resp_total, trial, n_trial_block, n_resp_scan
+):
+    update_str = f"Current Scan Block: {scan + 1} / {n_scan}\n\n"
+    update_str += f"Current Trial: {trial_idx + 1} / {n_trial}\n\n"
+    update_str += f"Total Responses: {n_resp_total} / {trial_idx}\n\n"
+    update_str += f"Trial within Block: {trial + 1} / {n_trial_block}\n\n"
+    update_str += f"Responses within Block: {n_resp_scan} / {trial}"
+    return update_str
+
+
+def render(stims, win_2, msg):
+    """
+    Draws a control screen message and flips the window
+
+    Parameters
+    ----------
+    stims : SimpleNamespace
+       Stimuli from make_control_stimuli
+    win_2 : Window
+       Control screen window
+    msg : tuple
+       ("start", text), ("instruct", text, wait_key), ("progress", *counts),
+       ("pause",) or ("clear",)
+    """
+    kind = msg[0]
+    if kind == "start":
+        stims.start_text.setText(msg[1])
+        stims.start_text.draw()
+    elif kind == "instruct":
+        stims.inst_2_text.setText(msg[1])
+        stims.inst_2_text.draw()
+        stims.cont_text.setText(f"Press {msg[2]} to continue")
+        stims.cont_text.draw()
+    elif kind == "progress":
+        stims.update_text.setText(format_progress(*msg[1:]))
+        stims.update_text.draw()
+    elif kind == "pause":
+        stims.update_text.setText("Task is paused. Press space to continue.")
+        stims.update_text.draw()
+    win_2.flip()
+
+
+class InlineControl:
+    """
+    Renders control screen messages synchronously in the task process
+    """
+
+    def __init__(self, visual, win_2, params):
+        self.win_2 = win_2
+        self.stims = make_control_stimuli(visual, win_2, params)
+
+    def send(self, *msg):
+        render(self.stims, self.win_2, msg)
+
+    def get_keys(self):
+        # Keys pressed on win_2 already reach the task's event.getKeys()
+        return []
+
+    def close(self):
+        pass
+
+
+class ControlProcess:
+    """
+    Renders control screen messages in a separate process
+
+    Parameters
+    ----------
+    params : dict
+       Task parameters (see params.json)
+    max_rate : float
+       Maximum number of control screen flips per second. Messages that
+       arrive faster are coalesced and only the newest one is shown.
+    fallback : callable
+       Returns an InlineControl to use if the process dies (e.g. psychopy
+       fails to import or the control screen does not exist). If None,
+       messages are dropped once the process is gone.
+    """
+
+    def __init__(self, params, max_rate=10, fallback=None):
+        ctx = mp.get_context("spawn")
+        self.msg_queue = ctx.Queue()
+        self.key_queue = ctx.Queue()
+        self.proc = ctx.Process(
+            target=_control_loop,
+            args=(params, self.msg_queue, self.key_queue, max_rate),
+            daemon=True,
+        )
+        self.proc.start()
+        self.fallback = fallback
+        self.inline = None
+        self.failed = False
+        self.alive()
+
+    def alive(self):
+        """
+        Returns True while the process runs. The first time it is found dead,
+        warns and switches to the fallback.
+        """
+        if self.failed is True:
+            return False
+        if self.proc.is_alive():
+            return True
+        self.failed = True
+        print(f"Control screen process exited with code {self.proc.exitcode}")
+        if self.fallback is not None:
+            try:
+                self.inline = self.fallback()
+                print("Drawing the control screen from the task process instead")
+            except Exception as err:
+                print(f"Could not open the control screen ({err}), running without it")
+        return False
+
+    def send(self, *msg):
+        if self.alive():
+            # Queue is unbounded and pickling happens on a feeder thread
+            self.msg_queue.put_nowait(msg)
+        elif self.inline is not None:
+            self.inline.send(*msg)
+
+    def get_keys(self):
+        """
+        Returns keys pressed while the control window had focus
+        """
+        if not self.alive():
+            return [] if self.inline is None else self.inline.get_keys()
+        try:
+            return self.key_queue.get_nowait()
+        except queue.Empty:
+            return []
+
+    def close(self):
+        if self.inline is not None:
+            self.inline.close()
+        elif self.failed is False and self.proc.is_alive():
+            self.msg_queue.put_nowait(("quit",))
+            self.proc.join(timeout=1)
+
+
+def _control_loop(params, msg_queue, key_queue, max_rate):
+    """
+    Owns the control window inside the child process
+    """
+    from psychopy import visual, event
+    from psychopy import monitors
+    import pyglet
+
+    from task_code import create_monitor
+
+    # Create monitor and window for control screen
+    screens = pyglet.canvas.get_display().get_screens()
+    con_scr = screens[params["monitor"]["con"]["id"]]
+    con_mon = create_monitor("con", params, con_scr, monitors)
+    win_2 = visual.Window(
+        fullscr=params["monitor"]["con"]["full_screen"],
+        color=(-1, -1, -1),
+        monitor=con_mon,
+        size=con_mon.getSizePix(),
+        screen=params["monitor"]["con"]["id"],
+    )
+    stims = make_control_stimuli(visual, win_2, params)
+
+    period = 1 / max_rate
+    pending = None
+    last_render = -period
+    while True:
+        # Keep only the newest message
+        try:
+            pending = msg_queue.get(timeout=period / 2)
+            while True:
+                pending = msg_queue.get_nowait()
+        except queue.Empty:
+            pass
+        if pending is not None and pending[0] == "quit":
+            break
+
+        # Render no more than max_rate times per second
+        now = time.perf_counter()
+        if pending is not None and now - last_render >= period:
+            render(stims, win_2, pending)
+            pending = None
+            last_render = now
+
+        # Forward keys to the task process
+        keys = event.getKeys()
+        if len(keys) > 0:
+            key_queue.put(keys)
+    win_2.close()
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+
+"""
+Live stream of trial events for the control room
+
+task_code.py publishes events (onsets, ends, keys, skips/pauses, dropped
+frames) through EventPublisher, which serves them on a local Unix domain
+socket (or host:port for TCP) from a background asyncio thread. Each message
+is a 4-byte big-endian length followed by a json object.
+
+Publishing never blocks the render loop. Events go into a bounded deque and
+are serialized and sent by the server thread; if the deque is full, or a
+client is not reading fast enough, events are dropped and counted.
+
+Run this file with an address to follow a running session from a terminal.
+"""
+
+# Load libraries
+import argparse
+import asyncio
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+
+HEADER = struct.Struct(">I")
+
+
+def get_args():
+    """
+    Function to parse input arguments
+    """
+
+    # Create parser
+    parser = argparse.ArgumentParser(description="Follow a running task session")
+    parser.add_argument(
+        "address", type=str, help="Unix socket path or host:port of the task"
+    )
+    return parser.parse_args()
+
+
+def pack_event(event):
+    """
+    Encodes an event as a length-prefixed json message
+    """
+    payload = json.dumps(event).encode()
+    return HEADER.pack(len(payload)) + payload
+
+
+class EventPublisher:
+    """
+    Serves trial events to any number of local subscribers
+
+    Parameters
+    ----------
+    address : str
+       Unix socket path, or host:port to use TCP
+    max_queue : int
+       Maximum number of events waiting to be sent before new events are dropped
+    max_buffer : int
+       Maximum number of unsent bytes per client before events to it are dropped
+    poll : float
+       How often (s) the server thread checks for new events
+    """
+
+    def __init__(self, address, max_queue=1024, max_buffer=65536, poll=0.01):
+        self.address = address
+        self.max_queue = max_queue
+        self.max_buffer = max_buffer
+        self.poll = poll
+        self.n_drop = 0
+        self.n_client_drop = 0
+        self._events = collections.deque()
+        self._clients = set()
+        self._stop = False
+        self._error = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout=5)
+
+        # Make a bad address fail here instead of dropping every event
+        if self._error is not None:
+            raise self._error
+
+    def publish(self, kind, **fields):
+        """
+        Queues an event without blocking. Returns False if it was dropped.
+        """
+        if len(self._events) >= self.max_queue:
+            self.n_drop += 1
+            return False
+        fields["event"] = kind
+        self._events.append(fields)
+        return True
+
+    def close(self):
+        """
+        Sends any queued events and a final summary, then stops the server
+        """
+        self._stop = True
+        self._thread.join(timeout=1)
+
+    def _run(self):
+        try:
+            asyncio.run(self._serve())
+        except Exception as err:
+            self._error = err
+            self._ready.set()
+
+    async def _serve(self):
+        if ":" in self.address:
+            host, port = self.address.rsplit(":", 1)
+            server = await asyncio.start_server(self._on_client, host, int(port))
+        else:
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            server = await asyncio.start_unix_server(self._on_client, self.address)
+        self._ready.set()
+
+        # Send events until closed
+        async with server:
+            while self._stop is False:
+                self._send_events()
+                await asyncio.sleep(self.poll)
+            self._send_events()
+            self._send(
+                {
+                    "event": "summary",
+                    "n_drop": self.n_drop,
+                    "n_client_drop": self.n_client_drop,
+                }
+            )
+            for writer in list(self._clients):
+                await writer.drain()
+                writer.close()
+        if ":" not in self.address and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def _send_events(self):
+        while len(self._events) > 0:
+            self._send(self._events.popleft())
+
+    def _send(self, event):
+        if len(self._clients) == 0:
+            return
+        data = pack_event(event)
+        for writer in list(self._clients):
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                self.n_client_drop += 1
+            else:
+                writer.write(data)
+
+    async def _on_client(self, reader, writer):
+        self._clients.add(writer)
+        try:
+            await reader.read()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._clients.discard(writer)
+
+
+def read_events(address):
+    """
+    Connects to a running session and yields events as dictionaries
+    """
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+
+    with sock, sock.makefile("rb") as fid:
+        while True:
+            header = fid.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            (n_bytes,) = HEADER.unpack(header)
+            yield json.loads(fid.read(n_bytes))
+
+
+def main():
+    # Run parser
+    args = get_args()
+
+    # Print one line per event, with running trial and key counts
+    n_onset = 0
+    n_key = 0
+    for event in read_events(args.address):
+        kind = event.pop("event")
+        if kind == "onset":
+            n_onset += 1
+        elif kind == "keys":
+            n_key += len(event["keys"])
+        fields = " ".join(f"{key}={value}" for key, value in event.items())
+        print(f"{kind:>14} | trials {n_onset:4} | keys {n_key:4} | {fields}")
+
+
+if __name__ == "__main__":
+    main()
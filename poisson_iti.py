@@ -3,7 +3,6 @@
 # Load libraries
 import argparse
 import numpy as np
-import scipy.optimize as opt
 
 
 def get_args():
@@ -49,6 +48,7 @@ def get_args():
         help="Acceptable difference between requested iti limits and optimized ones"
              "Default is 0.01"
     )
+    parser.add_argument("-seed", type=int, help="Random seed")
     return parser.parse_args()
 
 
@@ -69,7 +69,7 @@ def nlc_wrap(y):
 
 
 def poisson_iti(
-    n_trial, min_iti, mean_iti, max_iti, n_bin=12, delay=0, tr=None, tol=0.01
+    n_trial, min_iti, mean_iti, max_iti, n_bin=12, delay=0, tr=None, tol=0.01, rng=None
 ):
     """
     Generates inter-trial intervals and timings according to an approximate poisson
@@ -93,6 +93,8 @@ def poisson_iti(
        Time between frames (s)
     tol : float
         Acceptable difference between optimized time intervals and requested constraints
+    rng : Generator
+       Random number generator. Default is the global numpy random state.
 
     Returns
     -------
@@ -108,17 +110,22 @@ def poisson_iti(
        If tr specified, converts t to zero-based frame indices.
     """
 
+    # scipy.optimize is slow to import, so only load it when needed
+    import scipy.optimize as opt
+
     # Define params of desired exponential distribution
     exp_min = 0
     exp_max = max_iti - min_iti
     exp_lmbda = mean_iti - min_iti
     exp_sum = n_trial * exp_lmbda
     exp_mean = 1 / exp_lmbda
+    if rng is None:
+        rng = np.random
     
     while True:
 
         # Generate initial itis
-        iti = np.random.exponential(exp_lmbda, n_trial)
+        iti = rng.exponential(exp_lmbda, n_trial)
         iti[iti > exp_max] = exp_max
 
         # Compute simulated and expected pdf given input parameters
@@ -161,6 +168,119 @@ def poisson_iti(
     return iti_hat, dur_hat, np.round(iti_hat / tr), np.round(dur_hat / tr)
 
 
+def poisson_iti_batch(
+    min_iti, mean_iti, max_iti, counts=None, shape=None, rng=None, n_iter=50
+):
+    """
+    Generates many inter-trial interval schedules at once
+
+    Each schedule is a draw from an exponential distribution, shifted so its
+    smallest interval is min_iti. It is then scaled and clipped at max_iti so
+    that the mean is exactly mean_iti and at least one interval equals max_iti.
+    The scale of every schedule is found by bisection over the whole batch, and
+    schedules that cannot meet the constraints are redrawn.
+
+    Parameters
+    ----------
+    min_iti : float
+       Minimum inter-trial interval (s)
+    mean_iti : float
+       Mean inter-trial interval (s)
+    max_iti : float
+       Maximum inter-trial interval (s)
+    counts : array
+       Trial counts with one schedule per count (e.g. trials per scan)
+    shape : tuple
+       (n_schedule, n_trial) shape of a batch of equal length schedules. Give
+       either counts or shape.
+    rng : Generator
+       Random number generator. Default is the global numpy random state.
+    n_iter : int
+       Number of bisection steps
+
+    Returns
+    -------
+    iti : array
+       Array of shape (n_schedule, n_trial) if shape is given. Otherwise all
+       schedules concatenated into one array.
+    offsets : array
+       Index of the first interval of each schedule in the flattened iti array,
+       followed by the total number of intervals
+    """
+
+    # Trial counts of each schedule
+    if (counts is None) == (shape is None):
+        raise ValueError("Give either counts or shape")
+    if shape is not None:
+        if len(shape) != 2:
+            raise ValueError(f"shape must be (n_schedule, n_trial), not {shape}")
+        counts = np.full(shape[0], shape[1], dtype=np.int64)
+    else:
+        counts = np.atleast_1d(np.asarray(counts, dtype=np.int64))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    # Define params of desired exponential distribution
+    exp_max = max_iti - min_iti
+    exp_lmbda = mean_iti - min_iti
+    if np.any(counts < 2) or np.any(exp_lmbda >= exp_max * (counts - 1) / counts):
+        raise ValueError(
+            f"Cannot reach a mean iti of {mean_iti} with a minimum of {min_iti} and "
+            f"a maximum of {max_iti} in {counts.min()} trials"
+        )
+    if rng is None:
+        rng = np.random
+
+    iti = np.empty(offsets[-1])
+    pending = np.arange(counts.shape[0])
+    while pending.shape[0] > 0:
+        n_pending = pending.shape[0]
+        sub_counts = counts[pending]
+        sub_start = np.concatenate([[0], np.cumsum(sub_counts)[:-1]])
+        seg = np.repeat(np.arange(n_pending), sub_counts)
+        target = exp_lmbda * sub_counts
+
+        # Generate initial itis, with the smallest of each schedule at zero
+        draw = rng.exponential(exp_lmbda, seg.shape[0])
+        draw -= np.minimum.reduceat(draw, sub_start)[seg]
+
+        def clipped_sum(scale):
+            return np.add.reduceat(np.minimum(scale[seg] * draw, exp_max), sub_start)
+
+        # Bracket the scale. Without clipping lo would give the target mean.
+        lo = target / np.add.reduceat(draw, sub_start)
+        hi = lo.copy()
+        short = clipped_sum(hi) < target
+        while np.any(short):
+            hi[short] *= 2
+            short = clipped_sum(hi) < target
+
+        # Bisect for the scale that gives the target mean after clipping
+        for _ in range(n_iter):
+            mid = (lo + hi) / 2
+            below = clipped_sum(mid) < target
+            lo = np.where(below, mid, lo)
+            hi = np.where(below, hi, mid)
+
+        # Solve exactly for the scale of the intervals that are not clipped
+        clip = hi[seg] * draw >= exp_max
+        n_clip = np.add.reduceat(clip.astype(np.int64), sub_start)
+        free_sum = np.add.reduceat(np.where(clip, 0, draw), sub_start)
+        scale = (target - exp_max * n_clip) / free_sum
+        hat = np.where(clip, exp_max, scale[seg] * draw)
+
+        # Keep schedules that meet the constraints, redraw the rest
+        free_max = np.maximum.reduceat(np.where(clip, 0, hat), sub_start)
+        valid = (n_clip > 0) & (scale > 0) & (free_max <= exp_max)
+        out = offsets[pending][seg] + np.arange(seg.shape[0]) - sub_start[seg]
+        keep = valid[seg]
+        iti[out[keep]] = hat[keep] + min_iti
+        pending = pending[~valid]
+
+    if shape is not None:
+        return iti.reshape(shape), offsets
+    return iti, offsets
+
+
 def main():
     # Run parser
     args = get_args()
@@ -174,7 +294,8 @@ def main():
         n_bin=args.bins,
         delay=args.delay,
         tr=args.tr,
-        tol=args.tol
+        tol=args.tol,
+        rng=np.random.default_rng(args.seed),
     )
 
     # Write output
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+"""
+Hot-path profiling for the task loop
+
+PhaseProfiler wraps the functions called inside a trial (flips, key polling,
+text updates, ...) so each call is timed with perf_counter_ns and added to a
+preallocated (trial x phase) array. Nothing is wrapped unless profiling is
+turned on in params.json, so a disabled profiler costs nothing.
+"""
+
+# Load libraries
+import time
+
+import numpy as np
+
+PHASES = (
+    "set_text",
+    "flip",
+    "get_keys",
+    "update_prog",
+    "mic_poll",
+    "keys",
+    "record",
+    "checkpoint",
+)
+PERCENTILES = (50, 95, 99)
+
+
+class PhaseProfiler:
+    """
+    Per-trial timing of named phases
+
+    Parameters
+    ----------
+    n_trial : int
+       Number of trials in the session. One extra row (index n_trial)
+       collects time spent outside trials, such as fixation, trigger waits,
+       and pauses. It is left out of the summary.
+    phases : tuple
+       Phase names
+    """
+
+    def __init__(self, n_trial, phases=PHASES):
+        self.phases = phases
+        self.trial = 0
+        self.total = np.zeros((n_trial + 1, len(phases)), dtype=np.int64)
+        self.peak = np.zeros((n_trial + 1, len(phases)), dtype=np.int64)
+        self.count = np.zeros((n_trial + 1, len(phases)), dtype=np.int64)
+
+    def wrap(self, phase, func):
+        """
+        Returns a version of func that times each call as phase
+        """
+        idx = self.phases.index(phase)
+        total = self.total
+        peak = self.peak
+        count = self.count
+        counter = time.perf_counter_ns
+
+        def timed(*args, **kwargs):
+            start = counter()
+            out = func(*args, **kwargs)
+            delta = counter() - start
+            trial = self.trial
+            total[trial, idx] += delta
+            count[trial, idx] += 1
+            if delta > peak[trial, idx]:
+                peak[trial, idx] = delta
+            return out
+
+        return timed
+
+    def summarize(self, scan, trials=None):
+        """
+        Computes per-trial latency percentiles for each phase, overall and per scan
+
+        Parameters
+        ----------
+        scan : array
+           Scan each trial ran in
+        trials : array
+           Trial number of each entry in scan. Default is the first len(scan)
+           trials. Trials not listed (skipped, or run before a resume) are
+           left out.
+
+        Returns
+        -------
+        rows : list
+           (scan, phase, calls, p50, p95, p99, max, max call) tuples in ms,
+           where scan is "all" for the whole session. Percentiles are of the
+           total time spent in the phase per trial.
+        """
+        n_trial = len(scan)
+        if trials is None:
+            trials = np.arange(n_trial)
+        groups = [("all", np.ones(n_trial, dtype=bool))]
+        groups += [(str(s), scan == s) for s in np.unique(scan)]
+        rows = []
+        for name, mask in groups:
+            total = self.total[trials][mask] / 1e6
+            pct = np.percentile(total, PERCENTILES, axis=0)
+            calls = self.count[trials][mask].sum(axis=0)
+            worst = self.peak[trials][mask].max(axis=0) / 1e6
+            for i, phase in enumerate(self.phases):
+                if calls[i] == 0:
+                    continue
+                rows.append(
+                    (name, phase, calls[i], *pct[:, i], total[:, i].max(), worst[i])
+                )
+        return rows
+
+    def report(self, scan, path=None, trials=None):
+        """
+        Prints the summary and optionally saves it as a csv file
+        """
+        rows = self.summarize(scan, trials=trials)
+        header = "Scan,Phase,Calls,P50,P95,P99,Max,Max.Call"
+        lines = [
+            f"{s},{p},{n},{p50:.4f},{p95:.4f},{p99:.4f},{mx:.4f},{mc:.4f}"
+            for s, p, n, p50, p95, p99, mx, mc in rows
+        ]
+        print("Per-trial phase latency (ms)")
+        print(
+            f"{'Scan':>5} {'Phase':>12} {'Calls':>7} {'P50':>8} {'P95':>8} "
+            f"{'P99':>8} {'Max':>8} {'Max.Call':>9}"
+        )
+        for s, p, n, p50, p95, p99, mx, mc in rows:
+            print(
+                f"{s:>5} {p:>12} {n:>7} {p50:8.3f} {p95:8.3f} {p99:8.3f} "
+                f"{mx:8.3f} {mc:9.3f}"
+            )
+        if path is not None:
+            with open(path, "w") as fid:
+                fid.write(header + "\n" + "\n".join(lines) + "\n")
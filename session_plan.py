@@ -0,0 +1,293 @@
+#!/usr/bin/python
+
+"""
+Compiles task parameters, participant, and seed into a session plan file
+
+A plan holds everything about a session that can be decided before the
+participant arrives: stem order, inter-trial intervals, planned onsets, and
+scan boundaries. task_code.py memory-maps the plan and runs it as is, so
+launching a session does no randomization, and the planned timeline can be
+compared exactly with the logged one afterwards.
+
+File layout is a magic line, a json header line padded to a multiple of 64
+bytes, and then the raw little-endian trial table.
+"""
+
+# Load libraries
+import argparse
+import json
+
+import numpy as np
+
+from poisson_iti import poisson_iti_batch
+from stem_index import StemIndex, load_orders
+
+PLAN_MAGIC = b"TASKPLAN 1\n"
+PLAN_ALIGN = 64
+
+
+def get_args():
+    """
+    Function to parse input arguments
+    """
+
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description="Compile parameters, participant, and seed into a session plan"
+    )
+    parser.add_argument("participant", type=str, help="Participant id")
+    parser.add_argument("task", type=str, choices=["wsct", "vismotor"], help="Task")
+    parser.add_argument(
+        "mode", type=str, choices=["experiment", "practice", "post_test"], help="Mode"
+    )
+    parser.add_argument("out", type=str, help="Name of output plan file")
+    parser.add_argument(
+        "-seed",
+        type=int,
+        help="Random seed. Default is to draw one and store it in the plan.",
+    )
+    parser.add_argument(
+        "-params",
+        type=str,
+        default="params.json",
+        help="Parameter file. Default is params.json.",
+    )
+    parser.add_argument(
+        "-orders",
+        type=str,
+        help="Study stem orders from stem_index.py. Default is to draw an order.",
+    )
+    parser.add_argument(
+        "-order",
+        type=int,
+        default=0,
+        help="Row of the orders file to use. Default is 0.",
+    )
+    return parser.parse_args()
+
+
+def plan_dtype(stem_len=8):
+    """
+    Returns the structured dtype of a plan's trial table
+    """
+    return np.dtype(
+        [
+            ("scan", "<u2"),
+            ("trial", "<u4"),
+            ("scan_trial", "<u4"),
+            ("stem", f"<U{stem_len}"),
+            ("iti", "<f8"),
+            ("onset", "<f8"),
+            ("end", "<f8"),
+            ("bold_bool", "?"),
+        ]
+    )
+
+
+def schedule_onsets(iti, n_trial_scan, ti, lead):
+    """
+    Computes planned trial onsets relative to the start of each scan
+
+    Parameters
+    ----------
+    iti : array
+       Inter-trial interval of every trial (s)
+    n_trial_scan : list
+       Number of trials in each scan
+    ti : float
+       Trial duration (s)
+    lead : array
+       Fixation time before the first trial of each scan (s)
+
+    Returns
+    -------
+    onset : array
+       Planned onset of each trial (s)
+    scan_dur : array
+       Planned duration of each scan, including fixation at both ends (s)
+    """
+    scan_start = np.concatenate([[0], np.cumsum(n_trial_scan)])
+    scan_idx = np.repeat(np.arange(len(n_trial_scan)), n_trial_scan)
+    dur = ti + np.asarray(iti)
+    elapsed = np.cumsum(dur) - dur
+    onset = elapsed - elapsed[scan_start[:-1]][scan_idx] + lead[scan_idx]
+    scan_dur = lead + np.add.reduceat(dur, scan_start[:-1]) + lead
+    return onset, scan_dur
+
+
+def compile_plan(params, task, mode, participant="", seed=None, stem_order=None):
+    """
+    Generates the full trial schedule for a session
+
+    Parameters
+    ----------
+    params : dict
+       Task parameters (see params.json)
+    task : str
+       wsct or vismotor
+    mode : str
+       experiment, practice, or post_test
+    participant : str
+       Participant id stored in the plan header
+    seed : int
+       Seed for stem shuffling and iti generation. Drawn from the OS if None.
+    stem_order : list
+       Stems to use in order, e.g. one order from stem_index.py. Default is to
+       shuffle the stem list as set in params.
+
+    Returns
+    -------
+    plan : array
+       Structured array with one row per trial (see plan_dtype). onset and end
+       are planned times relative to the trigger that starts each scan.
+    header : dict
+       Session metadata, including seed, scan boundaries, and the parameters
+       used to compile the plan
+    """
+
+    # Get number of trials/scans
+    task = task.lower()
+    mode = mode.lower().replace(" ", "_")
+    task_params = params["task"][task]
+    times = task_params["times"]
+    n_trial_scan = task_params["trials_per_scan"][mode]
+    bold_bool = task_params["trials_per_scan"]["bold_bool"][: len(n_trial_scan)]
+    n_trial = sum(n_trial_scan)
+    n_scan = len(n_trial_scan)
+    if mode == "post_test" or mode == "practice":
+        fix_time = times["test_fix"]
+    else:
+        fix_time = times["fix"]
+
+    # Seed everything from one generator
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    rng = np.random.default_rng(seed)
+
+    # Load in and shuffle stem list
+    if task == "wsct":
+        index = StemIndex.from_file(task_params["lists"][mode])
+        constraint = task_params["stem_constraint"]
+        if stem_order is not None:
+            stem_list = [str(stem) for stem in stem_order[:n_trial]]
+            if len(stem_list) < n_trial or len(set(stem_list)) < n_trial:
+                raise ValueError(f"Stem order needs {n_trial} unique stems")
+            if not np.isin(stem_list, index.stems).all():
+                raise ValueError("Stem order has stems that are not in the stem list")
+        elif task_params["shuffle_stems"] is True:
+            order = index.shuffle(1, n_trial, feature=constraint, rng=rng)[0]
+            stem_list = index.stems[order].tolist()
+        else:
+            index.check(n_trial)
+            stem_list = index.stems[:n_trial].tolist()
+    else:
+        stem_list = [""] * n_trial
+
+    # Get iti arrays
+    if times["iti"] == "variable":
+        iti, _ = poisson_iti_batch(
+            times["min"], times["mean"], times["max"], counts=n_trial_scan, rng=rng
+        )
+    else:
+        iti = np.repeat(float(times["iti"]), n_trial)
+
+    # Scan boundaries and fixation periods
+    scan_start = np.concatenate([[0], np.cumsum(n_trial_scan)])
+    scan_idx = np.repeat(np.arange(n_scan), n_trial_scan)
+    fix_bool = np.array([fix_time > 0 and bold is True for bold in bold_bool])
+    lead = np.where(fix_bool, fix_time, 0.0)
+
+    # Planned onsets relative to the start of each scan
+    onset, scan_dur = schedule_onsets(iti, n_trial_scan, times["ti"], lead)
+
+    # Fill in trial table
+    plan = np.zeros(n_trial, dtype=plan_dtype(max([len(s) for s in stem_list] + [1])))
+    plan["scan"] = scan_idx
+    plan["trial"] = np.arange(n_trial)
+    plan["scan_trial"] = np.arange(n_trial) - scan_start[scan_idx]
+    plan["stem"] = stem_list
+    plan["iti"] = iti
+    plan["onset"] = onset
+    plan["end"] = onset + times["ti"]
+    plan["bold_bool"] = fix_bool[scan_idx]
+
+    header = {
+        "participant": participant,
+        "task": task,
+        "mode": mode,
+        "seed": seed,
+        "n_trial": n_trial,
+        "n_trial_scan": list(n_trial_scan),
+        "scan_start": scan_start.tolist(),
+        "scan_duration": scan_dur.tolist(),
+        "bold_bool": fix_bool.tolist(),
+        "fix_time": fix_time,
+        "ti": times["ti"],
+        "params": params,
+    }
+    return plan, header
+
+
+def write_plan(path, plan, header):
+    """
+    Writes a plan and its header to a single file
+    """
+    header = dict(header, dtype=np.lib.format.dtype_to_descr(plan.dtype))
+    header_bytes = json.dumps(header).encode()
+    pad = -(len(PLAN_MAGIC) + len(header_bytes) + 1) % PLAN_ALIGN
+    with open(path, "wb") as fid:
+        fid.write(PLAN_MAGIC)
+        fid.write(header_bytes + b" " * pad + b"\n")
+        fid.write(np.ascontiguousarray(plan).tobytes())
+
+
+def read_plan(path):
+    """
+    Memory-maps a plan file
+
+    Returns
+    -------
+    plan : memmap
+       Read-only trial table
+    header : dict
+       Session metadata
+    """
+    with open(path, "rb") as fid:
+        if fid.readline() != PLAN_MAGIC:
+            raise ValueError(f"{path} is not a session plan file")
+        header = json.loads(fid.readline())
+        offset = fid.tell()
+    dtype = np.dtype([tuple(field) for field in header.pop("dtype")])
+    plan = np.memmap(
+        path, dtype=dtype, mode="r", offset=offset, shape=(header["n_trial"],)
+    )
+    return plan, header
+
+
+def main():
+    # Run parser
+    args = get_args()
+    with open(args.params, "r") as fid:
+        params = json.load(fid)
+
+    # Get stem order from study orders if given
+    if args.orders is not None:
+        index, orders, _ = load_orders(args.orders)
+        stem_order = index.stems[orders[args.order]]
+    else:
+        stem_order = None
+
+    # Compile and save plan
+    plan, header = compile_plan(
+        params,
+        args.task,
+        args.mode,
+        participant=args.participant,
+        seed=args.seed,
+        stem_order=stem_order,
+    )
+    write_plan(args.out, plan, header)
+
+
+if __name__ == "__main__":
+    main()
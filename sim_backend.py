@@ -0,0 +1,370 @@
+#!/usr/bin/python
+
+"""
+Headless stand-in for the parts of psychopy/pyglet used by task_code.py
+
+Everything runs on a virtual clock. Time only moves forward when the task
+blocks: a window flip advances to the next vsync, and a countdown timer or
+event.getKeys() that is polled twice in a row with nothing else in between is
+treated as a busy-wait and jumps straight to the next deadline. A full session
+therefore runs in a fraction of a second and writes the same output files as a
+real one.
+
+Keys come from a merged stream of scripted (time, key) events and random
+button presses/scanner triggers. Whenever the task spins on event.getKeys()
+(instructions, trigger waits, pauses) the "advance" keys are pressed after a
+short virtual delay, so sessions never hang waiting for a human.
+"""
+
+# Load libraries
+import datetime
+import heapq
+import random
+import wave
+from types import SimpleNamespace
+
+
+class VirtualClock:
+    """
+    Shared virtual time base for all simulated objects
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.frame_rate = 60.0
+        self.last_poll = None
+
+    def poll(self, obj):
+        """
+        Records that obj was polled and returns True if it was also the last
+        object polled (i.e. the caller is spinning on it).
+        """
+        spinning = self.last_poll is obj
+        self.last_poll = obj
+        return spinning
+
+    def advance(self, t):
+        if t > self.now:
+            self.now = t
+
+
+_clock = VirtualClock()
+_config = SimpleNamespace(
+    dialog={},
+    n_screen=1,
+    advance_keys=["space"],
+    advance_delay=0.5,
+)
+_keys = SimpleNamespace(stream=iter(()), pending=None)
+
+
+def _poisson_stream(rate, key, rng, start=0.0):
+    t = start
+    while True:
+        t += rng.expovariate(rate)
+        yield (t, key)
+
+
+def _regular_stream(period, key, start=0.0):
+    t = start
+    while True:
+        t += period
+        yield (t, key)
+
+
+def read_key_script(path):
+    """
+    Reads a scripted key stream from a csv file with time,key on each line.
+    Multi-letter entries such as "skip" or "pause" are typed one letter at a time.
+    """
+    events = []
+    with open(path) as fid:
+        for line in fid:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            time, key = line.split(",", 1)
+            key = key.strip()
+            if len(key) > 1 and key in ["skip", "pause"]:
+                events += [(float(time), letter) for letter in key]
+            else:
+                events.append((float(time), key))
+    return sorted(events)
+
+
+def configure(
+    dialog=None,
+    n_screen=1,
+    frame_rate=60.0,
+    advance_keys=("space",),
+    advance_delay=0.5,
+    script=(),
+    resp_key=None,
+    resp_rate=0.0,
+    trig_key=None,
+    tr=None,
+    seed=None,
+):
+    """
+    Resets the virtual clock and sets up the simulated environment
+
+    Parameters
+    ----------
+    dialog : dict
+       Dialog answers keyed by field label (e.g. {"Task:": "VISMOTOR"}).
+       Missing fields get the first choice or "sim".
+    n_screen : int
+       Number of screens reported by the simulated display
+    frame_rate : float
+       Refresh rate (Hz) of simulated windows
+    advance_keys : list
+       Keys pressed whenever the task busy-waits on event.getKeys(). trig_key
+       is left out when there is a trigger stream, so scans start on the TR
+       grid.
+    advance_delay : float
+       Virtual time (s) before the advance keys are pressed
+    script : list
+       Scripted (time, key) events, times are seconds from session start
+    resp_key : str
+       Key used for random responses
+    resp_rate : float
+       Mean number of random responses per second
+    trig_key : str
+       Key used for scanner triggers
+    tr : float
+       Time between scanner triggers (s)
+    seed : int
+       Seed for the random streams
+    """
+    _clock.now = 0.0
+    _clock.frame_rate = frame_rate
+    _clock.last_poll = None
+    _config.dialog = {} if dialog is None else dict(dialog)
+    _config.n_screen = n_screen
+    _config.advance_keys = [
+        key for key in advance_keys if tr is None or key != trig_key
+    ]
+    _config.advance_delay = advance_delay
+
+    # Merge scripted and random key streams
+    rng = random.Random(seed)
+    streams = [iter(sorted(script))]
+    if resp_key is not None and resp_rate > 0:
+        streams.append(_poisson_stream(resp_rate, resp_key, rng))
+    if trig_key is not None and tr is not None:
+        streams.append(_regular_stream(tr, trig_key))
+    _keys.stream = heapq.merge(*streams)
+    _keys.pending = next(_keys.stream, None)
+
+
+def get_time():
+    return _clock.now
+
+
+def quit():
+    raise SystemExit(0)
+
+
+class Clock:
+    def __init__(self):
+        self._reset_time = _clock.now
+
+    def reset(self, newT=0.0):
+        self._reset_time = _clock.now + newT
+
+    def getTime(self):
+        _clock.poll(self)
+        return _clock.now - self._reset_time
+
+
+class CountdownTimer:
+    def __init__(self, start=0):
+        self._deadline = _clock.now + start
+
+    def reset(self, t=0):
+        self._deadline = _clock.now + t
+
+    def addTime(self, t):
+        self._deadline += t
+
+    def getTime(self):
+        remaining = self._deadline - _clock.now
+        if _clock.poll(self) and remaining > 0:
+            _clock.advance(self._deadline)
+            remaining = 0.0
+        return remaining
+
+
+def get_keys(keyList=None, timeStamped=False):
+    """
+    Simulated version of psychopy.event.getKeys
+    """
+    spinning = _clock.poll(get_keys)
+
+    # If the task is busy-waiting for input, jump to the next key or press the
+    # advance keys, whichever comes first
+    events = []
+    if spinning:
+        next_time = _clock.now + _config.advance_delay
+        if _keys.pending is not None and _keys.pending[0] <= next_time:
+            _clock.advance(_keys.pending[0])
+        else:
+            _clock.advance(next_time)
+            events = [(_clock.now, key) for key in _config.advance_keys]
+
+    # Collect scripted/random keys that have occurred
+    while _keys.pending is not None and _keys.pending[0] <= _clock.now:
+        events.append(_keys.pending)
+        _keys.pending = next(_keys.stream, None)
+    if keyList is not None:
+        events = [event for event in events if event[1] in keyList]
+
+    if timeStamped is False:
+        return [key for _, key in events]
+    if timeStamped is True:
+        return [[key, t] for t, key in events]
+    return [[key, t - timeStamped._reset_time] for t, key in events]
+
+
+class Window:
+    def __init__(self, size=(800, 600), **kwargs):
+        self.size = list(size)
+        self.monitorFramePeriod = 1 / _clock.frame_rate
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def flip(self):
+        _clock.poll(self)
+        frame = 1 / _clock.frame_rate
+        _clock.advance((int(_clock.now / frame + 1e-9) + 1) * frame)
+        return _clock.now
+
+    def close(self):
+        pass
+
+
+class Stim:
+    """
+    Generic simulated stimulus (text, checkerboard, shapes, images)
+    """
+
+    def __init__(self, win=None, text="", contrast=1.0, **kwargs):
+        self.win = win
+        self.text = text
+        self.contrast = contrast
+        self.autoDraw = False
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def setText(self, text):
+        self.text = text
+
+    def draw(self):
+        pass
+
+
+class Dlg:
+    def __init__(self, title=""):
+        self.title = title
+        self.OK = True
+        self._fields = []
+
+    def addField(self, label, initial="", choices=None, **kwargs):
+        if label in _config.dialog:
+            value = _config.dialog[label]
+        elif choices is not None:
+            value = choices[0]
+        elif initial != "":
+            value = initial
+        else:
+            value = "sim"
+        self._fields.append(value)
+
+    def show(self):
+        return list(self._fields)
+
+
+def get_date_str(format="%Y-%m-%d_%Hh%M.%S.%f"):
+    return datetime.datetime.now().strftime(format)[:-3]
+
+
+class Monitor:
+    def __init__(self, name, width=None, distance=None, **kwargs):
+        self.name = name
+        self.width = width
+        self.distance = distance
+        self._size_pix = [800, 600]
+
+    def setSizePix(self, size):
+        self._size_pix = list(size)
+
+    def getSizePix(self):
+        return self._size_pix
+
+
+class Clip:
+    def __init__(self, duration, sample_rate):
+        self.duration = duration
+        self.sample_rate = sample_rate
+
+    def save(self, path):
+        # Audio content is not simulated, so write a valid but empty wav file
+        with wave.open(path, "wb") as fid:
+            fid.setnchannels(1)
+            fid.setsampwidth(2)
+            fid.setframerate(self.sample_rate)
+            fid.writeframes(b"")
+
+
+class Microphone:
+    def __init__(self, device=0, sampleRateHz=48000, **kwargs):
+        self.sample_rate = sampleRateHz
+        self._start = None
+        self._stop = None
+
+    def start(self):
+        self._start = _clock.now
+
+    def stop(self):
+        self._stop = _clock.now
+
+    def poll(self):
+        pass
+
+    def getRecording(self):
+        return Clip(self._stop - self._start, self.sample_rate)
+
+    def clear(self):
+        self._start = self._stop = None
+
+
+class Screen:
+    def __init__(self, x=0, y=0, width=1920, height=1080):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+
+class Display:
+    def get_screens(self):
+        return [Screen(x=1920 * i) for i in range(_config.n_screen)]
+
+
+# Namespaces mirroring the psychopy/pyglet modules used by the task
+visual = SimpleNamespace(
+    Window=Window,
+    TextStim=Stim,
+    RadialStim=Stim,
+    Polygon=Stim,
+    ImageStim=Stim,
+    Circle=Stim,
+)
+event = SimpleNamespace(getKeys=get_keys)
+core = SimpleNamespace(
+    Clock=Clock, CountdownTimer=CountdownTimer, getTime=get_time, quit=quit
+)
+gui = SimpleNamespace(Dlg=Dlg)
+data = SimpleNamespace(getDateStr=get_date_str)
+monitors = SimpleNamespace(Monitor=Monitor)
+pyglet = SimpleNamespace(canvas=SimpleNamespace(get_display=Display))
@@ -0,0 +1,301 @@
+#!/usr/bin/python
+
+"""
+Indexed word stem lists and constrained, seeded stem orders
+
+StemIndex reads a stem list once, removes duplicates, and stores letter
+features as arrays: unicode code points of every letter, the first letter,
+and the first two letters (bigram). Orders are drawn in batches of random
+permutations. Adjacent trials that share a feature are then repaired with
+random swaps across the whole batch. Rows that are still invalid after the
+repair steps are redrawn with the next batch.
+
+Run this file to generate the stem orders for a whole study up front, or to
+validate a saved set of orders.
+"""
+
+# Load libraries
+import argparse
+
+import numpy as np
+
+FEATURES = ("first", "bigram")
+
+
+def get_args():
+    """
+    Function to parse input arguments
+    """
+
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description="Generate or validate constrained stem orders for a study"
+    )
+    parser.add_argument("stems", type=str, help="Stem list, one stem per line")
+    parser.add_argument("out", type=str, help="Orders file (.npz)")
+    parser.add_argument(
+        "-n_order", type=int, default=1, help="Number of orders. Default is 1."
+    )
+    parser.add_argument(
+        "-n_trial",
+        type=int,
+        help="Number of trials per order. Default is the number of unique stems.",
+    )
+    parser.add_argument(
+        "-feature",
+        type=str,
+        default="first",
+        choices=FEATURES,
+        help="Feature adjacent trials may not share. Default is first.",
+    )
+    parser.add_argument("-seed", type=int, help="Random seed")
+    parser.add_argument(
+        "-validate",
+        action="store_true",
+        help="Validate the orders in out against stems instead of generating them",
+    )
+    return parser.parse_args()
+
+
+def load_stems(path):
+    """
+    Reads a word stem list, removing new lines
+    """
+    with open(path) as fid:
+        return [stem.strip() for stem in fid.readlines()]
+
+
+class StemIndex:
+    """
+    Unique word stems with letter features
+
+    Parameters
+    ----------
+    stems : list
+       Word stems. Blank entries and repeats of an earlier stem are dropped.
+    """
+
+    def __init__(self, stems):
+        stems = np.array([stem for stem in stems if stem != ""])
+        if stems.shape[0] == 0:
+            raise ValueError("Stem list is empty")
+        _, first_idx = np.unique(stems, return_index=True)
+        self.n_dup = stems.shape[0] - first_idx.shape[0]
+        self.stems = stems[np.sort(first_idx)]
+
+        # Letter code points, zero padded to the longest stem
+        n_stem = self.stems.shape[0]
+        self.letters = self.stems.view(np.uint32).reshape(n_stem, -1)
+        self.first = self.letters[:, 0].astype(np.int64)
+        if self.letters.shape[1] > 1:
+            self.bigram = (self.first << 21) | self.letters[:, 1]
+        else:
+            self.bigram = self.first << 21
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Indexes a stem list file
+        """
+        return cls(load_stems(path))
+
+    def __len__(self):
+        return self.stems.shape[0]
+
+    def feature(self, name):
+        """
+        Returns the first letter or bigram code of every stem
+        """
+        if name not in FEATURES:
+            raise ValueError(f"Unknown stem feature {name}, use one of {FEATURES}")
+        return getattr(self, name)
+
+    def check(self, n_trial, feature=None):
+        """
+        Makes sure there are enough unique stems for n_trial trials and, if a
+        feature is given, that adjacent trials can always differ in it
+        """
+        if len(self) < n_trial:
+            raise ValueError(
+                f"Stem list has {len(self)} unique stems but {n_trial} trials are "
+                "needed"
+            )
+        if feature is not None and len(self) == n_trial:
+            _, counts = np.unique(self.feature(feature), return_counts=True)
+            if counts.max() > (n_trial + 1) // 2:
+                raise ValueError(
+                    f"{counts.max()} of {n_trial} stems share a {feature} feature, "
+                    "so some adjacent trials must share it"
+                )
+
+    def shuffle(
+        self, n_order, n_trial, feature="first", rng=None, batch=1024, max_iter=None
+    ):
+        """
+        Draws random stem orders in which adjacent trials differ in a feature
+
+        Parameters
+        ----------
+        n_order : int
+           Number of orders
+        n_trial : int
+           Number of trials in each order
+        feature : str
+           first or bigram. If None, orders are unconstrained.
+        rng : Generator
+           Random number generator. Default is a new unseeded generator.
+        batch : int
+           Number of orders drawn and repaired together
+        max_iter : int
+           Number of swap steps before a row is redrawn. Default is 4 * n_trial.
+
+        Returns
+        -------
+        orders : array
+           Array of shape (n_order, n_trial) with indices into stems
+        """
+        self.check(n_trial, feature=feature)
+        if rng is None:
+            rng = np.random.default_rng()
+        if max_iter is None:
+            max_iter = 4 * n_trial
+        n_stem = len(self)
+        orders = np.empty((n_order, n_trial), dtype=np.int64)
+        if feature is None:
+            for start in range(0, n_order, batch):
+                rows = rng.random((min(batch, n_order - start), n_stem))
+                orders[start : start + rows.shape[0]] = np.argsort(rows, axis=1)[
+                    :, :n_trial
+                ]
+            return orders
+        key = self.feature(feature)
+
+        n_done = 0
+        n_draw = 0
+        while n_done < n_order:
+            n_draw += 1
+            if n_draw > 100 * (n_order // batch + 1):
+                raise RuntimeError(f"Could not find {n_order} valid stem orders")
+
+            # Random permutations. Stems past n_trial are spares to swap in.
+            n_row = min(batch, n_order - n_done)
+            perm = np.argsort(rng.random((n_row, n_stem)), axis=1)
+            keys = key[perm]
+            rows = np.arange(n_row)
+
+            # Repair the first conflict of every row with a random swap, kept
+            # only if it creates no new conflicts around either position
+            for _ in range(max_iter):
+                conflict = keys[:, 1:n_trial] == keys[:, : n_trial - 1]
+                bad = conflict.any(axis=1)
+                if not bad.any():
+                    break
+                r = rows[bad]
+                j = conflict[bad].argmax(axis=1) + 1
+                k = rng.integers(0, n_stem, r.shape[0])
+                key_j = keys[r, j]
+                key_k = keys[r, k]
+                ok = np.abs(j - k) > 1
+                for pos, new in [(j, key_k), (k, key_j)]:
+                    for side in [pos - 1, pos + 1]:
+                        inside = (side >= 0) & (side < n_trial) & (pos < n_trial)
+                        side_key = keys[r, np.clip(side, 0, n_stem - 1)]
+                        ok &= ~inside | (side_key != new)
+                r, j, k = r[ok], j[ok], k[ok]
+                perm[r, j], perm[r, k] = perm[r, k], perm[r, j]
+                keys[r, j], keys[r, k] = keys[r, k], keys[r, j]
+
+            # Keep repaired rows, the rest are drawn again
+            valid = ~(keys[:, 1:n_trial] == keys[:, : n_trial - 1]).any(axis=1)
+            n_valid = min(valid.sum(), n_order - n_done)
+            orders[n_done : n_done + n_valid] = perm[valid][:n_valid, :n_trial]
+            n_done += n_valid
+        return orders
+
+    def validate(self, orders, feature="first"):
+        """
+        Checks stem orders
+
+        Returns
+        -------
+        valid : array
+           True for each order that only uses known stems, never repeats one,
+           and (if feature is not None) never repeats a feature in adjacent
+           trials
+        """
+        orders = np.atleast_2d(orders)
+        valid = np.all((orders >= 0) & (orders < len(self)), axis=1)
+        ordered = np.sort(orders, axis=1)
+        valid &= ~np.any(ordered[:, 1:] == ordered[:, :-1], axis=1)
+        if feature is not None:
+            keys = self.feature(feature)[np.clip(orders, 0, len(self) - 1)]
+            valid &= ~np.any(keys[:, 1:] == keys[:, :-1], axis=1)
+        return valid
+
+
+def save_orders(path, index, orders, feature, seed):
+    """
+    Saves stem orders together with the stems they index
+    """
+    np.savez(
+        path,
+        stems=index.stems,
+        orders=orders,
+        feature=np.array("" if feature is None else feature),
+        seed=np.array(-1 if seed is None else seed),
+    )
+
+
+def load_orders(path):
+    """
+    Loads a file written by save_orders
+
+    Returns
+    -------
+    index : StemIndex
+       Index of the stems the orders refer to
+    orders : array
+       Stem orders, one per row
+    feature : str
+       Feature the orders were constrained on, or None
+    """
+    with np.load(path) as data:
+        index = StemIndex(data["stems"].tolist())
+        orders = data["orders"]
+        feature = str(data["feature"]) or None
+    return index, orders, feature
+
+
+def main():
+    # Run parser
+    args = get_args()
+    index = StemIndex.from_file(args.stems)
+    if index.n_dup > 0:
+        print(f"Dropped {index.n_dup} duplicate stems")
+
+    # Check saved orders against the stem list
+    if args.validate is True:
+        saved, orders, feature = load_orders(args.out)
+        if not np.array_equal(saved.stems, index.stems):
+            print(f"Stems in {args.out} do not match {args.stems}")
+            raise SystemExit(1)
+        valid = index.validate(orders, feature=feature)
+        print(f"{valid.sum()} of {valid.shape[0]} orders are valid")
+        if not valid.all():
+            raise SystemExit(1)
+        return
+
+    # Generate orders
+    n_trial = len(index) if args.n_trial is None else args.n_trial
+    orders = index.shuffle(
+        args.n_order,
+        n_trial,
+        feature=args.feature,
+        rng=np.random.default_rng(args.seed),
+    )
+    save_orders(args.out, index, orders, args.feature, args.seed)
+    print(f"Saved {args.n_order} orders of {n_trial} stems to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,125 +1,190 @@
 #!/usr/bin/env python
 
-# Import necessary libs and change preferences
+"""
+Runs the word-stem completion (WSCT) and visual motor (VISMOTOR) tasks
+
+Importing this module has no side effects. psychopy, pyglet and git are only
+imported once a session is actually started. Trial schedules are built by
+session_plan.compile_plan, and a Session runs whichever plan it is given.
+"""
+
+# Import necessary libs (heavy modules are imported lazily)
+import argparse
+import gc
 import json
 import os
-import random
 import sys
+import time
+from types import SimpleNamespace
 
-src_dir = os.path.dirname(os.path.abspath(__file__))
-os.chdir(src_dir)
-import git
 import numpy as np
-from poisson_iti import poisson_iti
-import psychopy
-
-psychopy.prefs.hardware["audioLib"] = ["ptb", "pyo", "pygame", "sounddevice"]
-from psychopy import visual, event, core, gui, data, monitors
-from psychopy.sound import Microphone
-import pyglet
-
-# Function to display stimulus text
-def show_stim(stims, time, text=None, show_count=False, show_2=False):
-    # Update text if necessary
-    if text is not None:
-        for stim in stims:
-            stim.setText(text)
-
-    # Show debugging count
-    if show_count is True:
-        count_text.setText(f"{trial_idx:03} / {n_trial:03}")
-
-    # Update window and time
-    for stim in stims:
-        stim.autoDraw = True
-    win_1.flip()
-    timer.addTime(time)
-
-
-# Function to display instructions
-def show_instruct(text, screen_2=False, extra=None, wait_key="space"):
-    # Show text on screen 1
-    inst_text.setText(text)
-    inst_text.draw()
-    if extra is not None:
-        for stim in extra:
-            stim.draw()
-    win_1.flip()
-
-    # Show text on screen 2 if needed
-    if screen_2 is True:
-        inst_2_text.setText(text)
-        inst_2_text.draw()
-        cont_text.setText(f"Press {wait_key} to continue")
-        cont_text.draw()
-        win_2.flip()
-
-    # Wait for key press to continue
-    while True:
-        all_keys = event.getKeys()
-        if params["keys"]["exit"] in all_keys:
-            core.quit()
-        elif wait_key in all_keys:
-            break
-
-
-# Function to update progress text
-def update_prog(trial):
-    update_str = f"Current Scan Block: {scan + 1} / {n_scan}\n\n"
-    update_str += f"Current Trial: {trial_idx + 1} / {n_trial}\n\n"
-    update_str += f"Total Responses: {n_resp_total} / {trial_idx}\n\n"
-    update_str += f"Trial within Block: {trial + 1} / {n_trial_scan[scan]}\n\n"
-    update_str += f"Responses within Block: {n_resp_scan} / {trial}"
-    update_text.setText(update_str)
-    update_text.draw()
-    win_2.flip()
-
-
-# Function for waiting until trigger has occured n times
-def wait_trig(n_trig, trig_key, exit_key):
-    trig_cnt = 0
-    while trig_cnt < n_trig:
-        all_keys = event.getKeys()
-        if trig_key in all_keys:
-            trig_cnt += 1
-        elif exit_key in all_keys:
-            core.quit()
 
+from checkpoint import Checkpoint
+from control_screen import ControlProcess, InlineControl
+from event_stream import EventPublisher
+from profiler import PhaseProfiler
+from trial_buffers import KeyBuffer, TrialBuffer
 
-# Function that waits until timer goes below zero.
-def wait_timer(timer, exit_key, clock=False, exit=False, refresh_rate=8, invert=False):
-    global exp_exit
-    global key_list
-    refresh_timer.reset(0)
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_args(argv=None):
+    """
+    Function to parse input arguments
+    """
 
-    # Wait until main timer is at zero
-    while timer.getTime() > 0:
-        # Draw all stimuli
-        win_1.flip()
-        refresh_timer.addTime(1 / refresh_rate)
+    # Create parser
+    parser = argparse.ArgumentParser(description="Run the WSCT/VISMOTOR task")
+    parser.add_argument(
+        "-sim",
+        help="Run headless on a virtual clock instead of psychopy",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "-sim_task",
+        default="WSCT",
+        choices=["WSCT", "VISMOTOR"],
+        help="Task to select in the simulated dialog. Default is WSCT.",
+    )
+    parser.add_argument(
+        "-sim_mode",
+        default="Experiment",
+        choices=["Experiment", "Practice", "Post Test"],
+        help="Mode to select in the simulated dialog. Default is Experiment.",
+    )
+    parser.add_argument(
+        "-sim_screens",
+        type=int,
+        default=1,
+        help="Number of simulated screens. Default is 1.",
+    )
+    parser.add_argument(
+        "-sim_keys",
+        type=str,
+        help="Csv file with scripted time,key events (e.g. 120,pause)",
+    )
+    parser.add_argument(
+        "-sim_rate",
+        type=float,
+        default=0.3,
+        help="Mean number of random button presses per second. Default is 0.3.",
+    )
+    parser.add_argument(
+        "-sim_tr",
+        type=float,
+        default=2.0,
+        help="Time between simulated scanner triggers (s). Default is 2.",
+    )
+    parser.add_argument("-sim_seed", type=int, help="Seed for simulated key streams")
+    parser.add_argument(
+        "-plan",
+        type=str,
+        help="Session plan file from session_plan.py. If not given, a plan is "
+        "compiled at launch and saved with the data.",
+    )
+    parser.add_argument(
+        "-seed",
+        type=int,
+        help="Seed used when compiling a plan at launch. Default is random.",
+    )
+    parser.add_argument(
+        "-resume",
+        type=str,
+        help="Checkpoint file (_ckpt.json) of an interrupted session. Resumes at "
+        "the first scan that did not finish, without the dialog or instructions.",
+    )
+    return parser.parse_args(argv)
+
+
+def load_params(path="params.json"):
+    """
+    Loads the json file containing task parameters
+    """
+    with open(path, "r") as fid:
+        return json.load(fid)
+
+
+def load_backend(args, params):
+    """
+    Imports psychopy/pyglet, or the headless simulation backend if requested
+
+    Parameters
+    ----------
+    args : Namespace
+       Parsed command line arguments
+    params : dict
+       Task parameters
+
+    Returns
+    -------
+    backend : SimpleNamespace
+       Object with visual, event, core, gui, data, monitors, Microphone, and
+       pyglet attributes
+    """
+    if args.sim is True:
+        import sim_backend
+
+        sim_backend.configure(
+            dialog={"Task:": args.sim_task, "Mode:": args.sim_mode},
+            n_screen=args.sim_screens,
+            advance_keys=["space", params["keys"]["trig"], params["keys"]["button"]],
+            script=[]
+            if args.sim_keys is None
+            else sim_backend.read_key_script(args.sim_keys),
+            resp_key=params["keys"]["button"],
+            resp_rate=args.sim_rate,
+            trig_key=params["keys"]["trig"],
+            tr=args.sim_tr,
+            seed=args.sim_seed,
+        )
+        return SimpleNamespace(
+            sim=True,
+            visual=sim_backend.visual,
+            event=sim_backend.event,
+            core=sim_backend.core,
+            gui=sim_backend.gui,
+            data=sim_backend.data,
+            monitors=sim_backend.monitors,
+            Microphone=sim_backend.Microphone,
+            pyglet=sim_backend.pyglet,
+        )
+
+    import psychopy
+
+    psychopy.prefs.hardware["audioLib"] = ["ptb", "pyo", "pygame", "sounddevice"]
+    from psychopy import visual, event, core, gui, data, monitors
+    from psychopy.sound import Microphone
+    import pyglet
+
+    return SimpleNamespace(
+        sim=False,
+        visual=visual,
+        event=event,
+        core=core,
+        gui=gui,
+        data=data,
+        monitors=monitors,
+        Microphone=Microphone,
+        pyglet=pyglet,
+    )
 
-        # Check keys
-        keys = event.getKeys(timeStamped=clock)
-        if len(keys) > 0:
-            key_list += keys
-            if type(keys[0]) is list:
-                keys = [key[0] for key in keys]
-            if exit_key in keys:
-                if exit is True:
-                    core.quit()
-                exp_exit = True
 
-        # Wait until refresh timer
-        while refresh_timer.getTime() > 0:
-            pass
+def get_git_hash(path):
+    """
+    Returns the commit hash of the repository at path, or "n/a"
+    """
+    try:
+        import git
 
-        # Invert checkboard so it flashes
-        if invert is True and check_stim.autoDraw is True:
-            check_stim.contrast *= -1
+        repo = git.Repo(path)
+        return repo.head.object.hexsha
+    except Exception:
+        return "n/a"
 
 
 # Function to create monitor object
-def create_monitor(mon_id, params, screen):
+def create_monitor(mon_id, params, screen, monitors):
     mon = monitors.Monitor(
         mon_id,
         width=params["monitor"][mon_id]["width"],
@@ -131,586 +196,1105 @@ def create_monitor(mon_id, params, screen):
     return mon
 
 
-# Load in json file containing parameters
-with open("params.json", "r") as fid:
-    params = json.load(fid)
-
-# Setup dialog box to get study info
-dlg = gui.Dlg(title="WSCT")
-dlg.addField("Participant:")
-dlg.addField("Experimenter:")
-dlg.addField("Task:", choices=["WSCT", "VISMOTOR"])
-dlg.addField("Mode:", choices=["Experiment", "Practice", "Post Test"])
-dlg_data = dlg.show()
-
-# Run dialog box
-if dlg.OK:
-    info_dic = {
-        "Participant": dlg_data[0],
-        "Experimenter": dlg_data[1],
-        "Task": dlg_data[2],
-        "Mode": dlg_data[3],
-        "Date": data.getDateStr(),
-    }
-    info_dic["Task"] = info_dic["Task"].lower()
-    info_dic["Mode"] = info_dic["Mode"].lower().replace(" ", "_")
-else:
-    core.quit()
-
-# Recording logic
-if (params["record"] is True and info_dic["Mode"] != "post_test") or (
-    params["record_test"] is True and info_dic["Mode"] == "post_test"
-):
-    record = True
-else:
-    record = False
-if record is True:
-    mic = Microphone(device=0, streamBufferSecs=60, maxRecordingSize=175e3)
-
-# Define data file names
-out_root = (
-    info_dic["Participant"]
-    + "_"
-    + info_dic["Date"]
-    + "_"
-    + info_dic["Task"]
-    + "_"
-    + info_dic["Mode"]
-)
-data_path = os.path.join("data/", out_root + "_data.csv")
-iti_path = os.path.join("data/", out_root + "_iti.csv")
-
-# Setup instructions
-if info_dic["Task"] == "wsct":
-    if info_dic["Mode"] == "experiment":
-        instructions = ["The task will begin when you see a white crosshair."]
-        final_msg = (
-            "The task is now over. Please remain still while additional"
-            + " scans are completed.\n\nThank you!"
+class Session:
+    """
+    Study information, output paths, and trial schedule for one session
+
+    Parameters
+    ----------
+    params : dict
+       Task parameters (see params.json)
+    info_dic : dict
+       Participant, Experimenter, Task, Mode, and Date entries. Task and Mode
+       are lower case, with spaces in Mode replaced by underscores. Raises
+       ValueError for a task/mode combination that does not exist.
+    """
+
+    def __init__(self, params, info_dic):
+        self.params = params
+        self.info_dic = info_dic
+        self.task = info_dic["Task"]
+        self.mode = info_dic["Mode"]
+        if self.task == "vismotor" and self.mode == "post_test":
+            raise ValueError("Post test is not an option for visual motor task")
+
+        # Recording logic
+        self.record = (params["record"] is True and self.mode != "post_test") or (
+            params["record_test"] is True and self.mode == "post_test"
         )
-        img_idx = None
-    elif info_dic["Mode"] == "practice":
-        instructions = [
-            "Welcome to the word-stem completion practice!\n\n"
-            "You will be presented with a three letter word stem and "
-            "asked to think of a word that completes it.\n\n"
-            "Please do not speak the word out loud.",
-            "For example, if you are shown HOU, you could think of "
-            "'HOUSE', 'HOUR', or 'HOUND'.",
-            "As you think of the word, please press the "
-            f"{params['button_color']} button on the controller.\n\n"
-            "Before we continue, could you press the "
-            f"{params['button_color']} button?",
-            "If you cannot think of an appropriate word, simply wait "
-            "for the next one.\n\nPractice will begin when you see "
-            "a white crosshair.",
-        ]
-        final_msg = (
-            "The practice session is over.\n\n" + "Do you need additional practice?"
+
+        # Define data file names
+        self.out_root = "_".join(
+            [info_dic["Participant"], info_dic["Date"], self.task, self.mode]
         )
-        img_idx = 2
-    else:
-        instructions = [
-            "Welcome to the word-stem completion post-test.\n\n"
-            "You will be shown a series of word stems and asked to "
-            "speak out loud a word that completes each stem.\n\n"
-            "Please press space when you are ready to start"
-        ]
-        final_msg = "The post-test session is complete.\n\n" + "Thank you!"
-        img_idx = None
-else:
-    if info_dic["Mode"] == "experiment":
-        instructions = ["The task will begin when you see a white crosshair."]
-        final_msg = (
-            "The task is now over. Please remain still while additional"
-            + " scans are completed.\n\nThank you!"
+        self.data_path = os.path.join("data/", self.out_root + "_data.csv")
+        self.iti_path = os.path.join("data/", self.out_root + "_iti.csv")
+        self.plan_path = os.path.join("data/", self.out_root + "_plan.bin")
+        self.flip_path = os.path.join("data/", self.out_root + "_flip.csv")
+        self.trig_path = os.path.join("data/", self.out_root + "_trig.csv")
+        self.prof_path = os.path.join("data/", self.out_root + "_prof.csv")
+        self.ckpt_path = os.path.join("data/", self.out_root + "_ckpt.json")
+
+        # Get number of trials/scans
+        self.task_params = params["task"][self.task]
+        self.n_trial_scan = self.task_params["trials_per_scan"][self.mode]
+        self.bold_bool = self.task_params["trials_per_scan"]["bold_bool"]
+        self.n_trial = sum(self.n_trial_scan)
+        self.n_scan = len(self.n_trial_scan)
+        self.scan_start = np.concatenate([[0], np.cumsum(self.n_trial_scan)]).tolist()
+        if self.mode == "post_test" or self.mode == "practice":
+            self.fix_time = self.task_params["times"]["test_fix"]
+        else:
+            self.fix_time = self.task_params["times"]["fix"]
+        self.ti = self.task_params["times"]["ti"]
+
+        self.plan = None
+        self.seed = None
+        self.stem_list = None
+        self.iti = None
+
+    @classmethod
+    def from_dialog(cls, params, gui, data, core, plan_header=None):
+        """
+        Shows the study info dialog and returns a new Session. If a plan header
+        is given, participant, task, and mode come from the plan.
+        """
+        dlg = gui.Dlg(title="WSCT")
+        if plan_header is None:
+            dlg.addField("Participant:")
+        dlg.addField("Experimenter:")
+        if plan_header is None:
+            dlg.addField("Task:", choices=["WSCT", "VISMOTOR"])
+            dlg.addField("Mode:", choices=["Experiment", "Practice", "Post Test"])
+        dlg_data = dlg.show()
+        if not dlg.OK:
+            core.quit()
+        if plan_header is None:
+            info_dic = {
+                "Participant": dlg_data[0],
+                "Experimenter": dlg_data[1],
+                "Task": dlg_data[2].lower(),
+                "Mode": dlg_data[3].lower().replace(" ", "_"),
+            }
+        else:
+            info_dic = {
+                "Participant": plan_header["participant"],
+                "Experimenter": dlg_data[0],
+                "Task": plan_header["task"],
+                "Mode": plan_header["mode"],
+            }
+        info_dic["Date"] = data.getDateStr()
+        return cls(params, info_dic)
+
+    @classmethod
+    def from_checkpoint(cls, params, ckpt):
+        """
+        Returns the Session an interrupted checkpoint was written for
+        """
+        if ckpt.state["out_root"] != "_".join(
+            [ckpt.state["info"][key] for key in ["Participant", "Date", "Task", "Mode"]]
+        ):
+            raise ValueError(f"Checkpoint {ckpt.path} does not match its study info")
+        return cls(params, ckpt.state["info"])
+
+    def set_plan(self, plan, header, path):
+        """
+        Runs the session from a (memory-mapped) plan, see session_plan.py.
+        Trial numbers are plan rows, so each scan starts at its scan_start row
+        even after an earlier scan was skipped.
+        """
+        if header["task"] != self.task or header["mode"] != self.mode:
+            raise ValueError(
+                f"Plan is for {header['task']}/{header['mode']} but session is "
+                f"{self.task}/{self.mode}"
+            )
+        self.plan = plan
+        self.plan_path = path
+        self.seed = header["seed"]
+        self.n_trial_scan = header["n_trial_scan"]
+        self.bold_bool = header["bold_bool"]
+        self.n_trial = header["n_trial"]
+        self.n_scan = len(self.n_trial_scan)
+        self.scan_start = header["scan_start"]
+        self.fix_time = header["fix_time"]
+        self.ti = header["ti"]
+        self.stem_list = plan["stem"]
+        self.iti = plan["iti"]
+
+    def instructions(self):
+        """
+        Returns the instruction screens, final message, and index of the
+        instruction screen that shows the button box (or None)
+        """
+        button_color = self.params["button_color"]
+        if self.task == "wsct":
+            if self.mode == "experiment":
+                instructions = ["The task will begin when you see a white crosshair."]
+                final_msg = (
+                    "The task is now over. Please remain still while additional"
+                    + " scans are completed.\n\nThank you!"
+                )
+                img_idx = None
+            elif self.mode == "practice":
+                instructions = [
+                    "Welcome to the word-stem completion practice!\n\n"
+                    "You will be presented with a three letter word stem and "
+                    "asked to think of a word that completes it.\n\n"
+                    "Please do not speak the word out loud.",
+                    "For example, if you are shown HOU, you could think of "
+                    "'HOUSE', 'HOUR', or 'HOUND'.",
+                    "As you think of the word, please press the "
+                    f"{button_color} button on the controller.\n\n"
+                    "Before we continue, could you press the "
+                    f"{button_color} button?",
+                    "If you cannot think of an appropriate word, simply wait "
+                    "for the next one.\n\nPractice will begin when you see "
+                    "a white crosshair.",
+                ]
+                final_msg = (
+                    "The practice session is over.\n\n"
+                    + "Do you need additional practice?"
+                )
+                img_idx = 2
+            else:
+                instructions = [
+                    "Welcome to the word-stem completion post-test.\n\n"
+                    "You will be shown a series of word stems and asked to "
+                    "speak out loud a word that completes each stem.\n\n"
+                    "Please press space when you are ready to start"
+                ]
+                final_msg = "The post-test session is complete.\n\n" + "Thank you!"
+                img_idx = None
+        else:
+            if self.mode == "experiment":
+                instructions = ["The task will begin when you see a white crosshair."]
+                final_msg = (
+                    "The task is now over. Please remain still while additional"
+                    + " scans are completed.\n\nThank you!"
+                )
+                img_idx = None
+            elif self.mode == "practice":
+                instructions = [
+                    "Welcome to the task practice session!\n\nYou "
+                    "will be presented with a flashing circular "
+                    "checkerboard.",
+                    "When you see the checkerboard please press the "
+                    f"{button_color} button on the "
+                    "controller.\n\nBefore we continue, could you press "
+                    f"the {button_color} button?",
+                    "Practice will begin when you see a white crosshair.",
+                ]
+                final_msg = (
+                    "The practice session is over.\n\n"
+                    + "Do you need additional practice?"
+                )
+                img_idx = 1
+            else:
+                raise ValueError("Post test is not an option for visual motor task")
+        return instructions, final_msg, img_idx
+
+    def write_header(self, sha, launch_time=None):
+        """
+        Creates the data files and writes the session header
+        """
+        os.makedirs("data/", exist_ok=True)
+        with open(self.data_path, "w") as data_file:
+            data_file.write("# Participant : " + self.info_dic["Participant"] + "\n")
+            data_file.write("# Experimenter : " + self.info_dic["Experimenter"] + "\n")
+            data_file.write("# Task : " + self.task + "\n")
+            data_file.write("# Mode : " + self.mode + "\n")
+            data_file.write("# Date : " + self.info_dic["Date"] + "\n")
+            data_file.write("# Git Commit Hash : " + sha + "\n")
+            if self.plan is not None:
+                data_file.write("# Plan : " + self.plan_path + "\n")
+                data_file.write(f"# Plan Seed : {self.seed}\n")
+            if launch_time is not None:
+                data_file.write(f"# Time to First Window : {launch_time:.3f}\n")
+            if self.task == "wsct":
+                data_file.write(
+                    "Scan,Scan.Start,Trial,Word,Onset,End,Key.List,Key.Bool,Rec.Start\n"
+                )
+            else:
+                data_file.write("Scan,Scan.Start,Trial,Onset,End,Key.List,Key.Bool\n")
+        with open(self.flip_path, "w") as flip_file:
+            flip_file.write("Scan,Trial,Flip,Control\n")
+        with open(self.trig_path, "w") as trig_file:
+            trig_file.write("Scan,Time\n")
+
+    def write_resume(self, scan, sha):
+        """
+        Marks in the data file where a resumed session starts. Rows written
+        before this line for scan or later belong to the interrupted run.
+        """
+        with open(self.data_path, "a") as data_file:
+            data_file.write(f"# Resume : {scan}\n")
+            data_file.write("# Resume Git Commit Hash : " + sha + "\n")
+
+
+class TrialRunner:
+    """
+    Owns the windows, stimuli, and clocks for a session and runs its scans
+
+    Parameters
+    ----------
+    session : Session
+       Session to run
+    backend : SimpleNamespace
+       psychopy-like modules returned by load_backend
+    """
+
+    def __init__(self, session, backend):
+        self.session = session
+        self.params = session.params
+        self.backend = backend
+        self.visual = backend.visual
+        self.event = backend.event
+        self.core = backend.core
+
+        # Trial state
+        self.trial_idx = 0
+        self.scan = 0
+        self.n_resp_total = 0
+        self.n_resp_scan = 0
+        self.trig_start = 0
+        self.exp_exit = False
+        self.control = None
+        self.prof = None
+        self.ckpt = None
+        self.first_scan = 0
+        self.n_dropped = 0
+        self.n_dropped_sent = 0
+
+        # Live event stream for the control room
+        stream_params = self.params["stream"]
+        self.stream = None
+        if stream_params["enabled"] is True:
+            try:
+                self.stream = EventPublisher(
+                    stream_params["address"], max_queue=stream_params["max_queue"]
+                )
+            except OSError as err:
+                print(
+                    f"Could not start event stream on {stream_params['address']} "
+                    f"({err}), running without it"
+                )
+
+        # Setup global clocks
+        self.timer = self.core.CountdownTimer()
+        self.refresh_timer = self.core.CountdownTimer()
+        self.clock = self.core.Clock()
+
+    def open_windows(self):
+        """
+        Opens the task window (and returns it), then sets up the second screen
+        window if there is one
+        """
+        params = self.params
+
+        # Get monitor information
+        display = self.backend.pyglet.canvas.get_display()
+        screens = display.get_screens()
+        self.n_screen = len(screens)
+        self.show_2 = self.n_screen == 2
+
+        # Create monitor and window for task
+        if self.n_screen > 1:
+            task_scr_id = params["monitor"]["task"]["id"]
+        else:
+            task_scr_id = 0
+        self.task_scr = screens[task_scr_id]
+        task_mon = create_monitor(
+            "task", params, self.task_scr, self.backend.monitors
         )
-        img_idx = None
-    elif info_dic["Mode"] == "practice":
-        instructions = [
-            "Welcome to the task practice session!\n\nYou "
-            "will be presented with a flashing circular "
-            "checkerboard.",
-            "When you see the checkerboard please press the "
-            f"{params['button_color']} button on the "
-            "controller.\n\nBefore we continue, could you press "
-            f"the {params['button_color']} button?",
-            "Practice will begin when you see a white crosshair.",
-        ]
-        final_msg = (
-            "The practice session is over.\n\n" + "Do you need additional practice?"
+        self.win_1 = self.visual.Window(
+            fullscr=params["monitor"]["task"]["full_screen"],
+            color=(-1, -1, -1),
+            monitor=task_mon,
+            size=task_mon.getSizePix(),
+            allowGUI=False,
+            pos=[self.task_scr.x, self.task_scr.y],
         )
-        img_idx = 1
-    else:
-        print("Post test is not an option for visual motor task")
-        sys.exit()
 
-# Get monitor information
-display = pyglet.canvas.get_display()
-screens = display.get_screens()
-n_screen = len(screens)
-
-# Create monitor and window for task
-if n_screen > 1:
-    task_scr_id = params["monitor"]["task"]["id"]
-else:
-    task_scr_id = 0
-task_scr = screens[task_scr_id]
-task_mon = create_monitor("task", params, task_scr)
-win_1 = visual.Window(
-    fullscr=params["monitor"]["task"]["full_screen"],
-    color=(-1, -1, -1),
-    monitor=task_mon,
-    size=task_mon.getSizePix(),
-    allowGUI=False,
-    pos=[task_scr.x, task_scr.y],
-)
-
-# Get number of trials/scans
-task_params = params["task"][info_dic["Task"]]
-n_trial_scan = task_params["trials_per_scan"][info_dic["Mode"]]
-n_trial = sum(n_trial_scan)
-n_scan = len(n_trial_scan)
-
-# Create file for data logging
-data_file = open(data_path, "w")
-data_file.write("# Participant : " + info_dic["Participant"] + "\n")
-data_file.write("# Experimenter : " + info_dic["Experimenter"] + "\n")
-data_file.write("# Task : " + info_dic["Task"] + "\n")
-data_file.write("# Mode : " + info_dic["Mode"] + "\n")
-data_file.write("# Date : " + info_dic["Date"] + "\n")
-try:
-    repo = git.Repo(src_dir)
-    sha = repo.head.object.hexsha
-except:
-    sha = "n/a"
-data_file.write("# Git Commit Hash : " + sha + "\n")
-if info_dic["Task"] == "wsct":
-    data_file.write("Scan,Scan.Start,Trial,Word,Onset,End,Key.List,Key.Bool,Rec.Start\n")
-else:
-    data_file.write("Scan,Scan.Start,Trial,Onset,End,Key.List,Key.Bool\n")
-data_file.close()
-
-# Fixation stimulus
-fix_stim = visual.TextStim(
-    win=win_1,
-    ori=0,
-    text="+",
-    font="Arial",
-    pos=[-0.01, 0.1425],
-    color="white",
-    depth=-5.0,
-    colorSpace="rgb",
-    opacity=1,
-    units=params["units"],
-    height=params["font_size"]["fix"],
-)
-if info_dic["Mode"] == "post_test" or info_dic["Mode"] == "practice":
-    fix_time = task_params["times"]["test_fix"]
-else:
-    fix_time = task_params["times"]["fix"]
-
-# Task specific prep
-if info_dic["Task"] == "wsct":
-    # Load in list and remove new lines
-    stem_path = task_params["lists"][info_dic["Mode"]]
-    with open(stem_path) as fid:
-        stem_list = fid.readlines()
-    stem_list = [stem.strip() for stem in stem_list]
-
-    # Shuffle list if neccessary
-    if params["task"]["wsct"]["shuffle_stems"] is True:
-        random.shuffle(stem_list)
-
-    # Create text stimulus for wordstem
-    stem_stim = visual.TextStim(
-        win_1,
-        pos=(0, 0),
-        color="white",
-        units=params["units"],
-        text="Initial Text",
-        height=params["font_size"]["stem"],
-        wrapWidth=params["wrap_width"],
-    )
-    task_stim = [stem_stim]
-    task_invert = False
-
-else:
-    # Create checkerboard stimulus
-    check_params = params["task"]["vismotor"]["check"]
-    check_stim = visual.RadialStim(
-        win_1,
-        pos=[0, 0],
-        tex="sqrXsqr",
-        ori=0,
-        interpolate=True,
-        color=1,
-        units=params["units"],
-        radialCycles=check_params["rad_cyc"],
-        angularCycles=check_params["ang_cyc"],
-        angularRes=check_params["ang_res"],
-        texRes=check_params["tex_res"],
-        size=check_params["size"],
-    )
+        # Setup second screen if necessary
+        if self.n_screen == 2:
+            con_params = params["monitor"]["con"]
+            if con_params["offload"] is True and self.backend.sim is False:
+                self.control = ControlProcess(
+                    params,
+                    max_rate=con_params["max_rate"],
+                    fallback=self.open_control,
+                )
+            else:
+                self.control = self.open_control()
+        return self.win_1
+
+    def open_control(self):
+        """
+        Opens the second screen window and returns a control screen drawn from
+        the task process
+        """
+        params = self.params
+        con_params = params["monitor"]["con"]
+        screens = self.backend.pyglet.canvas.get_display().get_screens()
+        con_scr = screens[con_params["id"]]
+        con_mon = create_monitor("con", params, con_scr, self.backend.monitors)
+        self.win_2 = self.visual.Window(
+            fullscr=con_params["full_screen"],
+            color=(-1, -1, -1),
+            monitor=con_mon,
+            size=con_mon.getSizePix(),
+            screen=con_params["id"],
+        )
+        return InlineControl(self.visual, self.win_2, params)
+
+    def make_stimuli(self):
+        """
+        Creates all stimuli used by the task
+        """
+        visual = self.visual
+        params = self.params
+        win_1 = self.win_1
+
+        # Fixation stimulus
+        self.fix_stim = visual.TextStim(
+            win=win_1,
+            ori=0,
+            text="+",
+            font="Arial",
+            pos=[-0.01, 0.1425],
+            color="white",
+            depth=-5.0,
+            colorSpace="rgb",
+            opacity=1,
+            units=params["units"],
+            height=params["font_size"]["fix"],
+        )
 
-    # Remove center portion of checkerboard stimulus
-    center_stim = visual.Polygon(
-        win=win_1,
-        edges=600,
-        size=[2, 2],
-        ori=0,
-        pos=[0, 0],
-        lineWidth=0,
-        lineColor=[1, 1, 1],
-        lineColorSpace="rgb",
-        fillColor="black",
-        fillColorSpace="rgb",
-        opacity=1,
-        depth=-4.0,
-        interpolate=True,
-        units=params["units"],
-    )
-    task_stim = [check_stim, center_stim, fix_stim]
-    task_text = None
-    task_invert = True
-
-# Common text stimului
-count_text = visual.TextStim(
-    win_1,
-    pos=(-8, -5),
-    color="white",
-    text="",
-    units=params["units"],
-    height=params["font_size"]["default"],
-    wrapWidth=params["wrap_width"],
-)
-inst_text = visual.TextStim(
-    win_1,
-    pos=(0, 0),
-    color="white",
-    text="Initial Text",
-    height=params["font_size"]["default"],
-    wrapWidth=params["wrap_width"],
-    units=params["units"],
-)
-
-# Get and save iti arrays
-if task_params["times"]["iti"] == "variable":
-    iti = np.zeros(n_trial)
-    start_idx = 0
-    for n in n_trial_scan:
-        scan_iti, _ = poisson_iti(
-            n,
-            task_params["times"]["min"],
-            task_params["times"]["mean"],
-            task_params["times"]["max"],
+        # Task specific prep
+        if self.session.task == "wsct":
+            # Create text stimulus for wordstem
+            stem_stim = visual.TextStim(
+                win_1,
+                pos=(0, 0),
+                color="white",
+                units=params["units"],
+                text="Initial Text",
+                height=params["font_size"]["stem"],
+                wrapWidth=params["wrap_width"],
+            )
+            self.task_stim = [stem_stim]
+            self.task_invert = False
+        else:
+            # Create checkerboard stimulus
+            check_params = params["task"]["vismotor"]["check"]
+            self.check_stim = visual.RadialStim(
+                win_1,
+                pos=[0, 0],
+                tex="sqrXsqr",
+                ori=0,
+                interpolate=True,
+                color=1,
+                units=params["units"],
+                radialCycles=check_params["rad_cyc"],
+                angularCycles=check_params["ang_cyc"],
+                angularRes=check_params["ang_res"],
+                texRes=check_params["tex_res"],
+                size=check_params["size"],
+            )
+
+            # Remove center portion of checkerboard stimulus
+            center_stim = visual.Polygon(
+                win=win_1,
+                edges=600,
+                size=[2, 2],
+                ori=0,
+                pos=[0, 0],
+                lineWidth=0,
+                lineColor=[1, 1, 1],
+                lineColorSpace="rgb",
+                fillColor="black",
+                fillColorSpace="rgb",
+                opacity=1,
+                depth=-4.0,
+                interpolate=True,
+                units=params["units"],
+            )
+            self.task_stim = [self.check_stim, center_stim, self.fix_stim]
+            self.task_invert = True
+
+        # Common text stimului
+        self.count_text = visual.TextStim(
+            win_1,
+            pos=(-8, -5),
+            color="white",
+            text="",
+            units=params["units"],
+            height=params["font_size"]["default"],
+            wrapWidth=params["wrap_width"],
+        )
+        self.inst_text = visual.TextStim(
+            win_1,
+            pos=(0, 0),
+            color="white",
+            text="Initial Text",
+            height=params["font_size"]["default"],
+            wrapWidth=params["wrap_width"],
+            units=params["units"],
         )
-        iti[start_idx : start_idx + n] = scan_iti
-        start_idx += n
-else:
-    iti = np.repeat(task_params["times"]["iti"], n_trial)
-np.savetxt(iti_path, iti)
-
-# Create image object for instructions
-button_img = visual.ImageStim(
-    win_1,
-    image="button_box.png",
-    pos=(0, -0.6),
-    ori=-90,
-    interpolate=True,
-    size=[0.4, task_scr.width / task_scr.height * 0.4],
-)
-
-# Make circle stimulus to outline correct button
-if params["button_color"] == "red":
-    circle_pos = (0.0975, -0.605)
-elif params["button_color"] == "green":
-    circle_pos = (0.03, -0.605)
-elif params["button_color"] == "yellow":
-    circle_pos = (-0.0375, -0.605)
-elif params["button_color"] == "blue":
-    circle_pos = (-0.105, -0.605)
-else:
-    raise ValueError("Unknown button color: " + _)
-circle_stim = visual.Circle(
-    win_1,
-    radius=0.03,
-    pos=circle_pos,
-    lineColor="white",
-    fillColor=None,
-    size=[1, task_scr.width / task_scr.height],
-    lineWidth=6,
-)
-
-# Setup second screen if necessary
-if n_screen == 2:
-    # Create monitor and window for object
-    con_scr = screens[params["monitor"]["con"]["id"]]
-    con_mon = create_monitor("con", params, con_scr)
-    win_2 = visual.Window(
-        fullscr=params["monitor"]["con"]["full_screen"],
-        color=(-1, -1, -1),
-        monitor=con_mon,
-        size=con_mon.getSizePix(),
-        screen=params["monitor"]["con"]["id"],
-    )
 
-    # Stimuli for second monitor
-    start_text = visual.TextStim(
-        win_2,
-        pos=(0, 0),
-        color="Blue",
-        text="Start Scan",
-        units=params["units"],
-        height=params["font_size"]["default"],
-        wrapWidth=params["wrap_width"],
-    )
-    inst_2_text = visual.TextStim(
-        win_2,
-        pos=(0, 0),
-        color="White",
-        text="",
-        units=params["units"],
-        wrapWidth=params["wrap_width"],
-        height=params["font_size"]["default"],
-    )
-    cont_text = visual.TextStim(
-        win_2,
-        pos=(0, -4.5),
-        color="Blue",
-        text="Press space to continue",
-        units=params["units"],
-        height=params["font_size"]["default"],
-        wrapWidth=params["wrap_width"],
-    )
-    update_text = visual.TextStim(
-        win_2,
-        pos=(0, 0),
-        color="Blue",
-        text="",
-        units=params["units"],
-        height=params["font_size"]["update"],
-        wrapWidth=params["wrap_width"],
-    )
+        # Create image object for instructions
+        task_scr = self.task_scr
+        self.button_img = visual.ImageStim(
+            win_1,
+            image="button_box.png",
+            pos=(0, -0.6),
+            ori=-90,
+            interpolate=True,
+            size=[0.4, task_scr.width / task_scr.height * 0.4],
+        )
 
-# Setup global clocks
-timer = core.CountdownTimer()
-refresh_timer = core.CountdownTimer()
-clock = core.Clock()
-
-# Show instructions
-show_2 = n_screen == 2
-for idx, instruct in enumerate(instructions):
-    stim_list = None
-    wait_key = "space"
-    if info_dic["Mode"] == "practice" and idx == img_idx:
-        stim_list = [button_img, circle_stim]
-        wait_key = params["keys"]["button"]
-    show_instruct(instruct, screen_2=show_2, extra=stim_list, wait_key=wait_key)
-win_1.flip()
-
-# Prep for loop
-data_list = []
-trial_idx = 0
-scan_start = 0
-n_resp_total = 0
-key_list = []
-
-# Debug
-if params["debug"] is True:
-    count_text.autoDraw = True
-
-# Loop through scans
-exp_exit = False
-for scan in range(n_scan):
-    # Tell control room to start scan
-    n_resp_scan = 0
-
-    # Add text to second screen
-    if n_screen == 2:
-        if info_dic["Mode"] != "experiment":
-            start_text.setText("Press space to start practice")
-        start_text.draw()
-        win_2.flip()
-
-    # Wait for trigger before doing anything
-    if info_dic["Mode"] != "post_test":
-        if info_dic["Mode"] != "experiment":
-            trig_key = "space"
+        # Make circle stimulus to outline correct button
+        if params["button_color"] == "red":
+            circle_pos = (0.0975, -0.605)
+        elif params["button_color"] == "green":
+            circle_pos = (0.03, -0.605)
+        elif params["button_color"] == "yellow":
+            circle_pos = (-0.0375, -0.605)
+        elif params["button_color"] == "blue":
+            circle_pos = (-0.105, -0.605)
         else:
-            trig_key = params["keys"]["trig"]
-        wait_trig(1, trig_key, params["keys"]["exit"])
-
-    # Reset time
-    timer.reset(0)
-    if scan == 0:
-        clock.reset()
-    scan_start_time = clock.getTime()
-
-    # Show cursor
-    if fix_time > 0 and task_params["trials_per_scan"]["bold_bool"][scan] is True:
-        show_stim([fix_stim], fix_time)
-        if n_screen == 2:
-            win_2.flip()
-        wait_timer(timer, params["keys"]["exit"], exit=True)
-        fix_stim.autoDraw = False
-
-    # Loop through number of trials per scan
-    for trial in range(n_trial_scan[scan]):
-        key_list = []
-
-        # Show first trial
-        if trial == 0:
-            start_time = clock.getTime()
-            if info_dic["Task"] == "wsct":
-                task_text = stem_list[trial_idx]
-            show_stim(
-                task_stim,
-                task_params["times"]["ti"],
-                text=task_text,
-                show_count=params["debug"],
+            raise ValueError("Unknown button color: " + params["button_color"])
+        self.circle_stim = visual.Circle(
+            win_1,
+            radius=0.03,
+            pos=circle_pos,
+            lineColor="white",
+            fillColor=None,
+            size=[1, task_scr.width / task_scr.height],
+            lineWidth=6,
+        )
+
+    # Function to display stimulus text
+    def show_stim(self, stims, time, text=None, show_count=False):
+        # Update text if necessary
+        if text is not None:
+            for stim in stims:
+                stim.setText(text)
+
+        # Show debugging count
+        if show_count is True:
+            self.count_text.setText(f"{self.trial_idx:03} / {self.session.n_trial:03}")
+
+        # Update window and time
+        for stim in stims:
+            stim.autoDraw = True
+        self.win_1.flip()
+        self.timer.addTime(time)
+
+    # Function to display instructions
+    def show_instruct(self, text, screen_2=False, extra=None, wait_key="space"):
+        # Show text on screen 1
+        self.inst_text.setText(text)
+        self.inst_text.draw()
+        if extra is not None:
+            for stim in extra:
+                stim.draw()
+        self.win_1.flip()
+
+        # Show text on screen 2 if needed
+        if screen_2 is True:
+            self.control.send("instruct", text, wait_key)
+
+        # Wait for key press to continue
+        while True:
+            all_keys = self.get_keys()
+            if self.params["keys"]["exit"] in all_keys:
+                self.quit()
+            elif wait_key in all_keys:
+                break
+
+    # Function to update progress text
+    def update_prog(self, trial):
+        session = self.session
+        self.control.send(
+            "progress",
+            self.scan,
+            session.n_scan,
+            self.trial_idx,
+            session.n_trial,
+            self.n_resp_total,
+            trial,
+            session.n_trial_scan[self.scan],
+            self.n_resp_scan,
+        )
+
+    # Function to get keys from the task window and the control screen
+    def get_keys(self, timeStamped=False):
+        keys = self.event.getKeys(timeStamped=timeStamped)
+        if self.control is not None:
+            con_keys = self.control.get_keys()
+            if len(con_keys) > 0:
+                if timeStamped is False:
+                    keys += con_keys
+                else:
+                    # Forwarded keys are stamped on arrival
+                    con_time = timeStamped.getTime()
+                    keys += [[key, con_time] for key in con_keys]
+        return keys
+
+    # Function for waiting until trigger has occured n times
+    def wait_trig(self, n_trig, trig_key, exit_key):
+        trig_cnt = 0
+        while trig_cnt < n_trig:
+            all_keys = self.get_keys()
+            if trig_key in all_keys:
+                trig_cnt += 1
+            elif exit_key in all_keys:
+                self.quit()
+
+    # Function that waits until timer goes below zero.
+    def wait_timer(
+        self, timer, exit_key, log_keys=False, exit=False, refresh_rate=8, invert=False
+    ):
+        self.refresh_timer.reset(0)
+
+        # A flip is late if it comes more than a frame after the loop period
+        late = 1 / refresh_rate + self.win_1.monitorFramePeriod
+        last_flip = None
+
+        # Wait until main timer is at zero
+        while timer.getTime() > 0:
+            # Draw all stimuli
+            self.win_1.flip()
+            self.refresh_timer.addTime(1 / refresh_rate)
+            flip_time = self.clock.getTime()
+            if last_flip is not None and flip_time - last_flip > late:
+                self.n_dropped += 1
+            last_flip = flip_time
+
+            # Check keys
+            keys = self.get_keys(timeStamped=self.clock)
+            if len(keys) > 0:
+                if self.stream is not None:
+                    self.stream.publish("keys", trial=self.trial_idx, keys=keys)
+                for key, key_time in keys:
+                    self.key_buf.add(key, key_time, self.scan, log=log_keys)
+                    if key == exit_key:
+                        if exit is True:
+                            self.quit()
+                        self.exp_exit = True
+
+            # Wait until refresh timer
+            while self.refresh_timer.getTime() > 0:
+                pass
+
+            # Invert checkboard so it flashes
+            if invert is True and self.check_stim.autoDraw is True:
+                self.check_stim.contrast *= -1
+
+    def run_instructions(self):
+        """
+        Shows the instruction screens
+        """
+        instructions, _, img_idx = self.session.instructions()
+        for idx, instruct in enumerate(instructions):
+            stim_list = None
+            wait_key = "space"
+            if self.session.mode == "practice" and idx == img_idx:
+                stim_list = [self.button_img, self.circle_stim]
+                wait_key = self.params["keys"]["button"]
+            self.show_instruct(
+                instruct, screen_2=self.show_2, extra=stim_list, wait_key=wait_key
             )
+        self.win_1.flip()
+
+    def run_scan(self, scan):
+        """
+        Runs all trials within a scan block and saves its data
+        """
+        session = self.session
+        params = self.params
+        fix_stim = self.fix_stim
+        task_stim = self.task_stim
+        key_buf = self.key_buf
+        stem_list = session.stem_list
+        iti = session.iti
+        clock = self.clock
+        timer = self.timer
+        exit_key = params["keys"]["exit"]
+        trig_key = params["keys"]["trig"]
+        task_text = None
+        self.scan = scan
+        self.trial_idx = session.scan_start[scan]
+        scan_start = self.trial_idx
+
+        # Tell control room to start scan
+        self.n_resp_scan = 0
+
+        # Add text to second screen
+        if self.n_screen == 2:
+            if session.mode != "experiment":
+                self.control.send("start", "Press space to start practice")
+            else:
+                self.control.send("start", "Start Scan")
 
-            # Update progress screen if necessary
-            if n_screen == 2:
-                update_prog(0)
+        # Clean up now so the garbage collector doesn't run during the scan
+        gc.collect()
+        gc.disable()
+        scan_key_start = key_buf.head
 
-            # Start recording if necessary
-            if record is True:
-                mic.start()
-                rec_start = round(clock.getTime(), 6)
+        # Time outside trials goes to the profiler's extra row
+        if self.prof is not None:
+            self.prof.trial = session.n_trial
+
+        # Wait for trigger before doing anything
+        if session.mode != "post_test":
+            if session.mode != "experiment":
+                self.wait_trig(1, "space", exit_key)
+            else:
+                self.wait_trig(1, trig_key, exit_key)
+
+        # Reset time
+        timer.reset(0)
+        if scan == self.first_scan:
+            clock.reset()
+        scan_start_time = clock.getTime()
+        if self.stream is not None:
+            self.stream.publish("scan_start", scan=scan, time=scan_start_time)
+
+        # Show cursor
+        if session.fix_time > 0 and session.bold_bool[scan] is True:
+            self.show_stim([fix_stim], session.fix_time)
+            if self.n_screen == 2:
+                self.control.send("clear")
+            self.wait_timer(timer, exit_key, exit=True)
+            fix_stim.autoDraw = False
+
+        # Loop through number of trials per scan
+        for trial in range(session.n_trial_scan[scan]):
+            key_start = key_buf.start_trial(self.trial_idx)
+            if self.prof is not None:
+                self.prof.trial = self.trial_idx
+
+            # Show first trial
+            if trial == 0:
+                start_time = clock.getTime()
+                if session.task == "wsct":
+                    task_text = stem_list[self.trial_idx]
+                self.show_stim(
+                    task_stim,
+                    session.ti,
+                    text=task_text,
+                    show_count=params["debug"],
+                )
+                self.flip_time[self.trial_idx] = clock.getTime()
+                self.publish_onset(scan, task_text)
+
+                # Update progress screen if necessary
+                con_start = time.perf_counter()
+                if self.n_screen == 2:
+                    self.update_prog(0)
+                self.con_time[self.trial_idx] = time.perf_counter() - con_start
+
+                # Start recording if necessary
+                if session.record is True:
+                    self.mic.start()
+                    rec_start = round(clock.getTime(), 6)
+                else:
+                    rec_start = np.nan
+
+            # Wait for trial period to end
+            self.wait_timer(timer, exit_key, log_keys=True, invert=self.task_invert)
+            for stim in task_stim:
+                stim.autoDraw = False
+            fix_stim.autoDraw = False
+            end_time = clock.getTime()
+            if self.stream is not None:
+                self.stream.publish("end", trial=self.trial_idx, time=end_time)
+
+            # Show fixation
+            self.show_stim([fix_stim], iti[self.trial_idx], show_count=params["debug"])
+
+            # Wait for iti to end
+            self.wait_timer(timer, exit_key, log_keys=True)
+            fix_stim.autoDraw = False
+            if self.stream is not None:
+                self.publish_dropped()
+            self.trial_idx += 1
+
+            # Get user input
+            key_stop = key_buf.head
+            skip = key_buf.skip
+            pause = key_buf.pause
+
+            # Pause if necessary
+            if pause is True:
+                pause_start = clock.getTime()
+                if self.stream is not None:
+                    self.stream.publish("pause", trial=self.trial_idx, time=pause_start)
+                if self.prof is not None:
+                    self.prof.trial = session.n_trial
+
+                # Let exerimenter know we are in pause mode
+                if self.n_screen == 2:
+                    self.control.send("pause")
+
+                # Wait for space bar to continue
+                self.wait_trig(1, "space", exit_key)
+
+                # Removed time in apuse from timer
+                pause_end = clock.getTime()
+                timer.addTime(pause_end - pause_start)
+                if self.prof is not None:
+                    self.prof.trial = self.trial_idx - 1
+                if self.stream is not None:
+                    self.stream.publish("resume", time=pause_end)
+            next_time = clock.getTime()
+
+            # Start next trial
+            if trial != session.n_trial_scan[scan] - 1 and skip is False:
+                if session.task == "wsct":
+                    task_text = stem_list[self.trial_idx]
+                self.show_stim(
+                    task_stim,
+                    session.ti,
+                    text=task_text,
+                    show_count=params["debug"],
+                )
+                self.flip_time[self.trial_idx] = clock.getTime()
+                self.publish_onset(scan, task_text)
+                con_start = time.perf_counter()
+                if self.n_screen == 2:
+                    resp_bool = key_buf.n_button > 0
+                    self.n_resp_scan += resp_bool
+                    self.n_resp_total += resp_bool
+                    self.update_prog(trial + 1)
+                self.con_time[self.trial_idx] = time.perf_counter() - con_start
             else:
-                rec_start = "N/A"
-                
-        # Wait for trial period to end
-        wait_timer(timer, params["keys"]["exit"], clock=clock, invert=task_invert)
-        for stim in task_stim:
-            stim.autoDraw = False
-        fix_stim.autoDraw = False
-        end_time = clock.getTime()
-
-        # Show fixation
-        show_stim([fix_stim], iti[trial_idx], show_count=params["debug"])
-
-        # Wait for iti to end
-        wait_timer(timer, params["keys"]["exit"], clock=clock)
-        fix_stim.autoDraw = False
-        trial_idx += 1
-
-        # Get user input
-        key_list = [key for key in key_list if key[0] != params["keys"]["trig"]]
-        resp_keys = [key[0] for key in key_list]
-        key_bool = [key[0] == params["keys"]["button"] for key in key_list]
-        skip = all(key in resp_keys for key in list("skip"))
-        pause = all(key in resp_keys for key in list("pause"))
-
-        # Pause if necessary
-        if pause is True:
-            pause_start = clock.getTime()
-
-            # Let exerimenter know we are in pause mode
-            if n_screen == 2:
-                pause_str = "Task is paused. Press space to continue."
-                update_text.setText(pause_str)
-                update_text.draw()
-                win_2.flip()
-
-            # Wait for space bar to continue
-            wait_trig(1, "space", params["keys"]["exit"])
-
-            # Removed time in apuse from timer
-            pause_end = clock.getTime()
-            timer.addTime(pause_end - pause_start)
-        next_time = clock.getTime()
-
-        # Start next trial
-        if trial != n_trial_scan[scan] - 1 and skip is False:
-            if info_dic["Task"] == "wsct":
-                task_text = stem_list[trial_idx]
-            show_stim(
-                task_stim,
-                task_params["times"]["ti"],
-                text=task_text,
-                show_count=params["debug"],
+                self.show_stim([fix_stim], 0, show_count=params["debug"])
+
+            # Save data from previous trial
+            self.trial_buf.add(
+                self.trial_idx - 1,
+                scan,
+                scan_start_time,
+                stem_list[self.trial_idx - 1],
+                start_time,
+                end_time,
+                rec_start,
+                (key_start, key_stop),
             )
-            if n_screen == 2:
-                resp_bool = any(key_bool)
-                n_resp_scan += resp_bool
-                n_resp_total += resp_bool
-                update_prog(trial + 1)
-        else:
-            show_stim([fix_stim], 0, show_count=params["debug"])
-
-        # Save data from previous trial
-        if info_dic["Task"] == "wsct":
-            data_list.append(
-                [
-                    scan,
-                    round(scan_start_time, 6),
-                    trial_idx - 1,
-                    stem_list[trial_idx - 1],
-                    round(start_time, 6),
-                    round(end_time, 6),
-                    key_list,
-                    key_bool,
-                    rec_start
-                ]
+            if pause is False:
+                start_time = next_time
+            if session.record is True:
+                self.mic.poll()
+            if self.ckpt is not None:
+                self.ckpt.trial_done(scan, self.trial_idx)
+
+            # Exit scan block if necessary
+            if skip is True:
+                if self.stream is not None:
+                    self.stream.publish("skip", scan=scan, trial=self.trial_idx)
+                break
+
+            # Quit if necessary
+            if self.exp_exit is True:
+                break
+
+        if self.prof is not None:
+            self.prof.trial = session.n_trial
+
+        # Save audio file if necessary
+        if session.record is True:
+            self.mic.stop()
+            audio_clip = self.mic.getRecording()
+            audio_path = os.path.join(
+                "audio/", session.out_root + "_" + str(scan) + ".wav"
             )
-        else:
-            data_list.append(
-                [
-                    scan,
-                    round(scan_start_time, 6),
-                    trial_idx - 1,
-                    round(start_time, 6),
-                    round(end_time, 6),
-                    key_list,
-                    key_bool,
-                ]
+            audio_clip.save(audio_path)
+            self.mic.clear()
+
+        if self.stream is not None:
+            n_done = self.trial_idx - scan_start
+            self.stream.publish("scan_end", scan=scan, n_trial=n_done)
+
+        # Update data file
+        if key_buf.n_lost(scan_key_start) > 0:
+            print(f"Key buffer overflowed, lost {key_buf.n_lost(scan_key_start)} keys")
+        with open(session.data_path, "a") as data_file:
+            data_file.writelines(
+                self.trial_buf.format_rows(
+                    scan_start, self.trial_idx, key_buf, word=session.task == "wsct"
+                )
+            )
+        with open(session.flip_path, "a") as flip_file:
+            for i in range(scan_start, self.trial_idx):
+                flip_file.write(
+                    f"{scan},{i},{self.flip_time[i]:.6f},{self.con_time[i]:.6f}\n"
+                )
+
+        # Show cursor
+        if session.fix_time > 0 and session.bold_bool[scan] is True:
+            self.show_stim([fix_stim], session.fix_time)
+            self.wait_timer(timer, exit_key, exit=True)
+            fix_stim.autoDraw = False
+
+        # Save triggers seen during the scan
+        with open(session.trig_path, "a") as trig_file:
+            trig_file.writelines(key_buf.format_trigs(self.trig_start, key_buf.n_trig))
+        self.trig_start = key_buf.n_trig
+        gc.enable()
+
+    def run(self, first_scan=0):
+        """
+        Runs every scan in the session from first_scan on, then shows the
+        final message
+        """
+        session = self.session
+        self.first_scan = first_scan
+        if session.record is True:
+            self.mic = self.backend.Microphone(
+                device=0, streamBufferSecs=60, maxRecordingSize=175e3
+            )
+            os.makedirs("audio/", exist_ok=True)
+
+        # Onset flip times and time spent updating the control screen after them
+        self.flip_time = np.full(session.n_trial, np.nan)
+        self.con_time = np.full(session.n_trial, np.nan)
+
+        # Trial records and key events
+        keys = self.params["keys"]
+        self.trial_buf = TrialBuffer(
+            session.n_trial, stem_len=max(1, session.stem_list.dtype.itemsize // 4)
+        )
+        self.key_buf = KeyBuffer(
+            max(session.n_trial_scan) * 32, keys["button"], keys["trig"]
+        )
+
+        # Debug
+        if self.params["debug"] is True:
+            self.count_text.autoDraw = True
+        if self.params["profile"] is True:
+            self.instrument()
+
+        # Loop through scans
+        for scan in range(first_scan, session.n_scan):
+            self.run_scan(scan)
+
+            # Exit if necessary
+            if self.exp_exit is True:
+                self.report_profile()
+                self.quit()
+            if self.ckpt is not None:
+                self.ckpt.scan_done(scan + 1, self.trial_idx, self.n_resp_total)
+        self.report_profile()
+
+        # Show final message
+        _, final_msg, _ = session.instructions()
+        self.fix_stim.autoDraw = False
+        self.show_instruct(final_msg, screen_2=self.show_2)
+        self.close()
+
+    def instrument(self):
+        """
+        Wraps the functions called within trials with a PhaseProfiler
+        """
+        prof = PhaseProfiler(self.session.n_trial)
+        for stim in self.task_stim:
+            if hasattr(stim, "setText"):
+                stim.setText = prof.wrap("set_text", stim.setText)
+        self.win_1.flip = prof.wrap("flip", self.win_1.flip)
+        self.get_keys = prof.wrap("get_keys", self.get_keys)
+        self.update_prog = prof.wrap("update_prog", self.update_prog)
+        if self.session.record is True:
+            self.mic.poll = prof.wrap("mic_poll", self.mic.poll)
+        self.key_buf.add = prof.wrap("keys", self.key_buf.add)
+        self.trial_buf.add = prof.wrap("record", self.trial_buf.add)
+        if self.ckpt is not None:
+            self.ckpt.trial_done = prof.wrap("checkpoint", self.ckpt.trial_done)
+        self.prof = prof
+
+    def report_profile(self):
+        """
+        Prints and saves phase latency percentiles for the trials that ran
+        """
+        if self.prof is None:
+            return
+        ran = np.flatnonzero(np.isfinite(self.flip_time[: self.trial_idx]))
+        if ran.shape[0] > 0:
+            scan = self.trial_buf.rows["scan"][ran]
+            self.prof.report(scan, path=self.session.prof_path, trials=ran)
+
+    def publish_onset(self, scan, text):
+        """
+        Publishes the onset of the current trial to the event stream
+        """
+        if self.stream is not None:
+            self.stream.publish(
+                "onset",
+                scan=scan,
+                trial=self.trial_idx,
+                time=self.flip_time[self.trial_idx],
+                stem=text,
+            )
+
+    def publish_dropped(self):
+        """
+        Publishes late flips of the task window since the last check. Only
+        flips within wait_timer are counted, against its refresh period, so
+        the long gaps of trigger waits and pauses are not reported.
+        """
+        if self.n_dropped != self.n_dropped_sent:
+            self.stream.publish(
+                "dropped_frames",
+                trial=self.trial_idx,
+                n=self.n_dropped - self.n_dropped_sent,
+                total=self.n_dropped,
+            )
+            self.n_dropped_sent = self.n_dropped
+
+    def close_stream(self):
+        """
+        Flushes and closes the event stream, reporting dropped events
+        """
+        if self.stream is not None:
+            self.stream.close()
+            print(
+                f"Event stream dropped {self.stream.n_drop} queued and "
+                f"{self.stream.n_client_drop} client events"
+            )
+            self.stream = None
+
+    def close(self):
+        """
+        Closes the control screen process and event stream. Safe to call more
+        than once.
+        """
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+        self.close_stream()
+
+    def quit(self):
+        """
+        Closes everything the runner started, then quits
+        """
+        self.close()
+        self.core.quit()
+
+
+def resume(args, params, backend, launch_start):
+    """
+    Resumes an interrupted session from its checkpoint, starting at the trigger
+    wait of the first scan that did not finish
+    """
+    from session_plan import read_plan
+
+    # Rebuild the session exactly as it was planned
+    ckpt = Checkpoint.load(args.resume)
+    state = ckpt.state
+    if state["complete"] is True:
+        print(f"Session {state['out_root']} is already complete")
+        return
+    session = Session.from_checkpoint(params, ckpt)
+    plan, plan_header = read_plan(state["plan"])
+    session.set_plan(plan, plan_header, state["plan"])
+    ckpt.check_plan(session)
+    first_scan = state["n_scan_done"]
+    if state["scan"] is not None:
+        print(
+            f"Scan {state['scan'] + 1} stopped after trial {state['trial_idx']}, "
+            f"rerunning it from trial {session.scan_start[first_scan] + 1}"
+        )
+
+    # Open windows and pick up the counts from the last finished scan
+    runner = TrialRunner(session, backend)
+    runner.open_windows()
+    print(f"Time to first window: {time.perf_counter() - launch_start:.3f} s")
+    runner.n_resp_total = state["n_resp_total"]
+    runner.ckpt = ckpt
+
+    # Append to the existing data files
+    try:
+        session.write_resume(first_scan, get_git_hash(src_dir))
+        runner.make_stimuli()
+        runner.run(first_scan=first_scan)
+    finally:
+        runner.close()
+    backend.core.quit()
+
+
+def main(argv=None):
+    launch_start = time.perf_counter()
+
+    # Run parser and load parameters
+    args = get_args(argv)
+    if args.plan is not None:
+        args.plan = os.path.abspath(args.plan)
+    if args.resume is not None:
+        args.resume = os.path.abspath(args.resume)
+    os.chdir(src_dir)
+    params = load_params()
+    backend = load_backend(args, params)
+
+    # Open session plan if we have one
+    from session_plan import compile_plan, read_plan, write_plan
+
+    if args.resume is not None:
+        resume(args, params, backend, launch_start)
+        return
+    if args.plan is not None:
+        plan, plan_header = read_plan(args.plan)
+    else:
+        plan_header = None
+
+    # Setup session from dialog box. Make sure task/mode combination is valid
+    # before opening any windows.
+    try:
+        session = Session.from_dialog(
+            params, backend.gui, backend.data, backend.core, plan_header=plan_header
+        )
+    except ValueError as err:
+        print(err)
+        sys.exit()
+
+    # Open the task window as early as possible
+    runner = TrialRunner(session, backend)
+    try:
+        runner.open_windows()
+        launch_time = time.perf_counter() - launch_start
+        print(f"Time to first window: {launch_time:.3f} s")
+
+        # Compile a plan now if one wasn't given
+        if args.plan is None:
+            plan, plan_header = compile_plan(
+                params,
+                session.task,
+                session.mode,
+                participant=session.info_dic["Participant"],
+                seed=args.seed,
             )
-        if pause is False:
-            start_time = next_time
-        if record is True:
-            mic.poll()
-
-        # Exit scan block if necessary
-        if skip is True:
-            break
-
-        # Quit if necessary
-        if exp_exit is True:
-            break
-
-    # Save audio file if necessary
-    if record is True:
-        mic.stop()
-        audio_clip = mic.getRecording()
-        audio_path = os.path.join("audio/", out_root + "_" + str(scan) + ".wav")
-        audio_clip.save(audio_path)
-        mic.clear()
-
-    # Update data file
-    with open(data_path, "a") as data_file:
-        for i in range(scan_start, trial_idx):
-            out_str = ",".join([str(item) for item in data_list[i]]) + "\n"
-            data_file.write(out_str)
-
-    # Show cursor
-    if fix_time > 0 and task_params["trials_per_scan"]["bold_bool"][scan] is True:
-        show_stim([fix_stim], fix_time)
-        wait_timer(timer, params["keys"]["exit"], exit=True)
-        fix_stim.autoDraw = False
-
-    # Update indicies for saving data
-    scan_start = trial_idx
-
-    # Exit if necessary
-    if exp_exit is True:
-        core.quit()
-
-# Show final message
-fix_stim.autoDraw = False
-show_instruct(final_msg, screen_2=show_2)
-
-# All done!
-core.quit()
+            os.makedirs("data/", exist_ok=True)
+            write_plan(session.plan_path, plan, plan_header)
+            plan, plan_header = read_plan(session.plan_path)
+            args.plan = session.plan_path
+        session.set_plan(plan, plan_header, args.plan)
+
+        # Create data file and stimuli
+        session.write_header(get_git_hash(src_dir), launch_time=launch_time)
+        runner.make_stimuli()
+        np.savetxt(session.iti_path, session.iti)
+        runner.ckpt = Checkpoint.create(session.ckpt_path, session)
+
+        # Show instructions and run task
+        runner.run_instructions()
+        runner.run()
+    finally:
+        runner.close()
+
+    # All done!
+    backend.core.quit()
+
+
+if __name__ == "__main__":
+    main()
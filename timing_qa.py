@@ -0,0 +1,624 @@
+#!/usr/bin/python
+
+"""
+Offline timing QA for task sessions
+
+Compares the schedule a session was supposed to run with what was logged. The
+planned schedule comes from the session's plan file when there is one, and is
+otherwise rebuilt from _iti.csv and the parameter file. Realized onsets come
+from the _flip.csv sidecar when present and from the Onset column of _data.csv
+otherwise.
+
+For each session this reports onset error, cumulative drift, the realized
+inter-trial interval distribution against the truncated exponential target,
+pauses, skips, and scanner trigger regularity, and flags sessions whose timing
+is too far off to use in a GLM.
+
+Notes
+-----
+Trial numbers are plan rows, and each scan starts at its own first row even
+after a skip. Planned onsets are computed from the ITIs of the trials that
+actually ran, which also covers data from sessions that kept counting trials
+across a skip.
+
+The Onset logged for the trial after a pause repeats the paused trial's onset.
+Those trials use the flip time when a flip sidecar exists and are left out of
+onset statistics otherwise. A pause also delays every later trial in the scan
+by its length, so errors are reported after removing that delay.
+"""
+
+# Load libraries
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+from session_plan import read_plan, schedule_onsets
+
+# A data row is the scalar fields, then Key.List (nested brackets), then
+# Key.Bool (flat brackets), then Rec.Start for the word task
+ROW_RE = re.compile(
+    r"^(?P<head>[^\[]*),(?P<keys>\[.*\]),(?P<bool>\[[^\[\]]*\])(?:,(?P<rec>[^\[\]]*))?$"
+)
+KEY_RE = re.compile(r"\['([^']*)', ")
+
+TRIAL_COLUMNS = (
+    "Session,Scan,Trial,Planned,Onset,Error,Corrected,Drift,End.Error,"
+    "ITI.Planned,ITI.Realized,Pause,Skip"
+)
+SUMMARY_COLUMNS = (
+    "Session,Task,Mode,Source,Trials.Planned,Trials.Run,Pauses,Pause.Time,Skips,"
+    "Stale.Onsets,Error.Mean,Error.P95,Error.Max,Drift.Max,Drift.Slope,"
+    "ITI.Target.Mean,ITI.Mean,ITI.Error.P95,ITI.KS,ITI.KS.Plan,ITI.KS.Real,"
+    "ITI.KS.Crit,"
+    "Triggers,TR,TR.Jitter,Triggers.Missing,Control.P95,Status"
+)
+
+
+def get_args():
+    """
+    Function to parse input arguments
+    """
+
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description="Compare planned and realized trial timing for task sessions"
+    )
+    parser.add_argument(
+        "paths",
+        type=str,
+        nargs="+",
+        help="Session data files (_data.csv) or study directories to search",
+    )
+    parser.add_argument(
+        "-params",
+        type=str,
+        default="params.json",
+        help="Parameter file for sessions without a plan. Default is params.json.",
+    )
+    parser.add_argument("-out", type=str, help="Save session summary to csv file")
+    parser.add_argument("-trials", type=str, help="Save per-trial timing to csv file")
+    parser.add_argument(
+        "-max_error",
+        type=float,
+        default=0.2,
+        help="Maximum 95th percentile of absolute onset error (s). Default is 0.2.",
+    )
+    parser.add_argument(
+        "-max_drift",
+        type=float,
+        default=0.25,
+        help="Maximum absolute cumulative drift within a scan (s). Default is 0.25.",
+    )
+    parser.add_argument(
+        "-alpha",
+        type=float,
+        default=0.05,
+        help="Significance level of the ITI distribution test. Default is 0.05.",
+    )
+    return parser.parse_args()
+
+
+def find_sessions(paths):
+    """
+    Expands directories into the session data files they contain
+    """
+    data_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            pattern = os.path.join(path, "**", "*_data.csv")
+            data_paths += sorted(glob.glob(pattern, recursive=True))
+        else:
+            data_paths.append(path)
+    return data_paths
+
+
+def read_data(path):
+    """
+    Reads a session data file
+
+    Parameters
+    ----------
+    path : str
+       Path to _data.csv file
+
+    Returns
+    -------
+    header : dict
+       Values of the commented header lines
+    rows : array
+       Structured array with scan, scan_start, trial, onset, end, and whether
+       the experimenter paused or skipped during each trial. If the session
+       was resumed, only the last run of each scan is kept.
+    """
+    header = {}
+    rows = []
+    with open(path) as fid:
+        for line in fid:
+            line = line.strip()
+            if line.startswith("#"):
+                key, _, value = line[1:].partition(" : ")
+                header[key.strip()] = value.strip()
+
+                # Rows of scans rerun after a resume replace the earlier ones
+                if key.strip() == "Resume":
+                    rows = [row for row in rows if row[0] < int(value)]
+                continue
+            match = ROW_RE.match(line)
+            if match is None:
+                continue
+            fields = match["head"].split(",")
+            keys = set(KEY_RE.findall(match["keys"]))
+            rows.append(
+                (
+                    int(fields[0]),
+                    float(fields[1]),
+                    int(fields[2]),
+                    float(fields[-2]),
+                    float(fields[-1]),
+                    set("pause") <= keys,
+                    set("skip") <= keys,
+                )
+            )
+    rows = np.array(
+        rows,
+        dtype=[
+            ("scan", "i4"),
+            ("scan_start", "f8"),
+            ("trial", "i4"),
+            ("onset", "f8"),
+            ("end", "f8"),
+            ("pause", "?"),
+            ("skip", "?"),
+        ],
+    )
+    return header, rows
+
+
+def read_sidecar(path, time_col):
+    """
+    Reads a flip or trigger csv file. Returns None if it does not exist or
+    has no rows, which is the case for sessions quit before a scan finished.
+
+    The clock restarts when a session is resumed, so a rerun scan shows up as
+    the scan or time column going backwards. Rows of the interrupted run of
+    that scan (and any later ones) are dropped.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as fid:
+        lines = fid.readlines()[1:]
+    if len(lines) == 0:
+        return None
+    table = np.loadtxt(lines, delimiter=",", ndmin=2)
+    scan = table[:, 0]
+    time = table[:, time_col]
+    same = scan[1:] == scan[:-1]
+    back = (scan[1:] < scan[:-1]) | (same & (time[1:] < time[:-1]))
+    keep = np.ones(table.shape[0], dtype=bool)
+    for idx in np.flatnonzero(back) + 1:
+        keep[:idx] &= scan[:idx] < scan[idx]
+    return table[keep]
+
+
+def load_session(data_path, params):
+    """
+    Loads everything needed to check the timing of one session
+
+    Parameters
+    ----------
+    data_path : str
+       Path to _data.csv file
+    params : dict
+       Task parameters used when the session has no plan file
+
+    Returns
+    -------
+    sess : SimpleNamespace
+       Data rows, planned itis (empty if _iti.csv is missing), trial duration, fixation lead per scan, iti
+       target, sidecars, and where the planned schedule came from
+    """
+    root = data_path[: -len("_data.csv")]
+    header, rows = read_data(data_path)
+    iti = np.array([])
+    if os.path.exists(root + "_iti.csv"):
+        iti = np.atleast_1d(np.loadtxt(root + "_iti.csv"))
+
+    # Find plan. Header path is relative to the task directory.
+    plan_path = None
+    for path in [header.get("Plan"), root + "_plan.bin"]:
+        if path is None:
+            continue
+        local = os.path.join(os.path.dirname(root), os.path.basename(path))
+        for candidate in [path, local]:
+            if os.path.exists(candidate):
+                plan_path = candidate
+                break
+        if plan_path is not None:
+            break
+
+    # Timing comes from the plan if possible
+    task = header["Task"].lower()
+    mode = header["Mode"].lower().replace(" ", "_")
+    plan_iti = None
+    if plan_path is not None:
+        plan, plan_header = read_plan(plan_path)
+        plan_iti = np.array(plan["iti"])
+        times = plan_header["params"]["task"][task]["times"]
+        ti = plan_header["ti"]
+        lead = np.where(plan_header["bold_bool"], plan_header["fix_time"], 0.0)
+        n_trial_scan = plan_header["n_trial_scan"]
+        source = "plan"
+    else:
+        task_params = params["task"][task]
+        times = task_params["times"]
+        ti = times["ti"]
+        n_trial_scan = task_params["trials_per_scan"][mode]
+        bold_bool = task_params["trials_per_scan"]["bold_bool"][: len(n_trial_scan)]
+        if mode == "post_test" or mode == "practice":
+            fix_time = times["test_fix"]
+        else:
+            fix_time = times["fix"]
+        lead = np.array([fix_time if bold is True else 0.0 for bold in bold_bool])
+        source = "params"
+
+    return SimpleNamespace(
+        name=os.path.basename(root),
+        task=task,
+        mode=mode,
+        rows=rows,
+        iti=iti,
+        plan_iti=plan_iti,
+        ti=ti,
+        lead=np.asarray(lead, dtype=float),
+        n_trial_scan=n_trial_scan,
+        times=times,
+        flip=read_sidecar(root + "_flip.csv", 2),
+        trig=read_sidecar(root + "_trig.csv", 1),
+        source=source,
+    )
+
+
+def truncated_exp_cdf(x, min_iti, mean_iti, max_iti):
+    """
+    CDF of the shifted exponential poisson_iti draws from, truncated at max_iti
+    """
+    scale = mean_iti - min_iti
+    norm = 1 - np.exp(-(max_iti - min_iti) / scale)
+    cdf = (1 - np.exp(-(np.asarray(x) - min_iti) / scale)) / norm
+    return np.clip(cdf, 0, 1)
+
+
+def ks_stat(x, cdf):
+    """
+    One-sample Kolmogorov-Smirnov statistic of x against a CDF
+    """
+    x = np.sort(x)
+    n = x.shape[0]
+    if n == 0:
+        return np.nan
+    f = cdf(x)
+    upper = np.arange(1, n + 1) / n - f
+    lower = f - np.arange(n) / n
+    return max(upper.max(), lower.max())
+
+
+def ks_stat_2(x, y):
+    """
+    Two-sample Kolmogorov-Smirnov statistic between x and y
+    """
+    x = np.sort(x)
+    y = np.sort(y)
+    if x.shape[0] == 0 or y.shape[0] == 0:
+        return np.nan
+    points = np.concatenate([x, y])
+    cdf_x = np.searchsorted(x, points, side="right") / x.shape[0]
+    cdf_y = np.searchsorted(y, points, side="right") / y.shape[0]
+    return np.max(np.abs(cdf_x - cdf_y))
+
+
+def scan_cumsum(values, first):
+    """
+    Cumulative sum that restarts at each scan. first is the index of the first
+    row of each row's scan.
+    """
+    total = np.cumsum(values)
+    return total - (total - values)[first]
+
+
+def analyze(sess, max_error=0.2, max_drift=0.25, alpha=0.05):
+    """
+    Computes trial and session timing metrics
+
+    Parameters
+    ----------
+    sess : SimpleNamespace
+       Session from load_session
+    max_error : float
+       Maximum 95th percentile of absolute onset error (s)
+    max_drift : float
+       Maximum absolute cumulative drift within a scan (s)
+    alpha : float
+       Significance level of the ITI distribution test
+
+    Returns
+    -------
+    trials : dict
+       Per-trial arrays for the columns in TRIAL_COLUMNS
+    summary : dict
+       Session metrics for the columns in SUMMARY_COLUMNS
+    """
+    rows = sess.rows
+    n_row = rows.shape[0]
+    scan = rows["scan"]
+    trial = rows["trial"]
+
+    # Rows are grouped by scan. Get first row of each row's scan.
+    scans, scan_first, scan_count = np.unique(
+        scan, return_index=True, return_counts=True
+    )
+    first = np.repeat(scan_first, scan_count)
+    same_scan = np.zeros(n_row, dtype=bool)
+    same_scan[1:] = scan[1:] == scan[:-1]
+
+    # Planned onsets of the trials that ran. Trials past the end of a short or
+    # missing _iti.csv have no planned iti.
+    has_iti = trial < sess.iti.shape[0]
+    planned_iti = np.full(n_row, np.nan)
+    planned_iti[has_iti] = sess.iti[trial[has_iti]]
+    rel, _ = schedule_onsets(planned_iti, scan_count, sess.ti, sess.lead[scans])
+    planned = rows["scan_start"] + rel
+    planned_end = planned + sess.ti
+
+    # Logged onset of the trial after a pause is stale
+    after_pause = np.zeros(n_row, dtype=bool)
+    after_pause[1:] = rows["pause"][:-1]
+    after_pause &= same_scan
+    onset = np.where(after_pause, np.nan, rows["onset"])
+    if sess.flip is not None and sess.flip.shape[0] > 0:
+        flip_trial = sess.flip[:, 1].astype(int)
+        order = np.argsort(flip_trial)
+        pos = np.clip(np.searchsorted(flip_trial[order], trial), 0, len(order) - 1)
+        found = flip_trial[order][pos] == trial
+        onset = np.where(found, sess.flip[order, 2][pos], onset)
+        control = sess.flip[:, 3]
+    else:
+        control = np.array([])
+    stale = after_pause & (rows["onset"] == np.roll(rows["onset"], 1))
+
+    # Pauses delay the rest of the scan. Estimate each delay from end times,
+    # which are always logged correctly.
+    end_error = rows["end"] - planned_end
+    delay = np.zeros(n_row)
+    paused = np.flatnonzero(after_pause) - 1
+    delay[after_pause] = end_error[after_pause] - end_error[paused]
+    offset = scan_cumsum(delay, first)
+
+    # Onset error and drift relative to the first trial of each scan
+    error = onset - planned
+    corrected = error - offset
+    valid = np.isfinite(corrected)
+    first_valid = np.where(valid, corrected, 0.0)[first]
+    drift = corrected - first_valid
+
+    # Drift slope within each scan (s per s), weighted least squares by scan
+    idx = np.searchsorted(scans, scan)
+    w = valid.astype(float)
+    t = np.where(valid, planned, 0.0)
+    e = np.where(valid, corrected, 0.0)
+    n = np.bincount(idx, w)
+    st = np.bincount(idx, w * t)
+    se = np.bincount(idx, w * e)
+    stt = np.bincount(idx, w * t * t)
+    ste = np.bincount(idx, w * t * e)
+    den = n * stt - st**2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = np.where(den > 0, (n * ste - st * se) / den, np.nan)
+
+    # Realized iti is next onset minus end, within a scan and without pauses
+    realized_iti = np.full(n_row, np.nan)
+    realized_iti[:-1] = onset[1:] - rows["end"][:-1]
+    has_next = np.zeros(n_row, dtype=bool)
+    has_next[:-1] = same_scan[1:]
+    realized_iti[~has_next | rows["pause"]] = np.nan
+    iti_ok = np.isfinite(realized_iti) & np.isfinite(planned_iti)
+    iti_error = realized_iti - planned_iti
+
+    # Compare realized and planned itis with the target distribution. Planned
+    # itis are adjusted to hit the min/mean/max exactly rather than drawn from
+    # the target, so only the change from planned to realized is tested.
+    n_iti = iti_ok.sum()
+    ks_real = ks_stat_2(realized_iti[iti_ok], planned_iti[iti_ok])
+    ks_crit = np.sqrt(-np.log(alpha / 2)) / np.sqrt(max(n_iti, 1))
+    times = sess.times
+    if times["iti"] == "variable":
+        min_iti, mean_iti, max_iti = times["min"], times["mean"], times["max"]
+
+        def cdf(x):
+            return truncated_exp_cdf(x, min_iti, mean_iti, max_iti)
+
+        ks = ks_stat(realized_iti[iti_ok], cdf)
+        ks_plan = ks_stat(planned_iti[iti_ok], cdf)
+        target_mean = mean_iti
+    else:
+        ks = ks_plan = np.nan
+        target_mean = float(times["iti"])
+
+    # Trigger regularity. Triggers are not logged while paused, so gaps that
+    # overlap a pause are left out.
+    n_trig = 0
+    tr = jitter = np.nan
+    n_missing = 0
+    if sess.trig is not None and sess.trig.shape[0] > 1:
+        n_trig = sess.trig.shape[0]
+        trig_time = sess.trig[:, 1]
+        pause_start = rows["end"][paused]
+        pause_end = rows["end"][after_pause] - sess.ti
+        in_pause = np.any(
+            (trig_time[:-1, None] < pause_end) & (trig_time[1:, None] > pause_start),
+            axis=1,
+        )
+        keep = (sess.trig[1:, 0] == sess.trig[:-1, 0]) & ~in_pause
+        gaps = np.diff(trig_time)[keep]
+        if gaps.shape[0] > 0:
+            tr = np.median(gaps)
+            jitter = np.std(gaps)
+            n_missing = int(np.sum(np.maximum(np.round(gaps / tr) - 1, 0)))
+    elif sess.trig is not None:
+        n_trig = sess.trig.shape[0]
+
+    # Flag anything that would bias a GLM
+    abs_error = np.abs(corrected[valid])
+    error_p95 = np.percentile(abs_error, 95) if abs_error.shape[0] > 0 else np.nan
+    drift_max = np.nanmax(np.abs(drift)) if valid.any() else np.nan
+    reasons = []
+    if not error_p95 <= max_error:
+        reasons.append("onset_error")
+    if not drift_max <= max_drift:
+        reasons.append("drift")
+    if ks_real > ks_crit:
+        reasons.append("iti_distribution")
+    if n_missing > 0:
+        reasons.append("missing_triggers")
+    if stale.any() and control.shape[0] == 0:
+        reasons.append("stale_onsets")
+    if not has_iti.all():
+        reasons.append("short_iti_file")
+    if sess.plan_iti is not None and (
+        sess.plan_iti.shape != sess.iti.shape
+        or not np.allclose(sess.plan_iti, sess.iti)
+    ):
+        reasons.append("plan_mismatch")
+    if n_row == 0:
+        reasons = ["no_trials"]
+
+    trials = {
+        "Scan": scan,
+        "Trial": trial,
+        "Planned": planned,
+        "Onset": onset,
+        "Error": error,
+        "Corrected": corrected,
+        "Drift": drift,
+        "End.Error": end_error - offset,
+        "ITI.Planned": planned_iti,
+        "ITI.Realized": realized_iti,
+        "Pause": rows["pause"].astype(int),
+        "Skip": rows["skip"].astype(int),
+    }
+    summary = {
+        "Session": sess.name,
+        "Task": sess.task,
+        "Mode": sess.mode,
+        "Source": sess.source,
+        "Trials.Planned": sum(sess.n_trial_scan),
+        "Trials.Run": n_row,
+        "Pauses": int(rows["pause"].sum()),
+        "Pause.Time": delay.sum(),
+        "Skips": int(rows["skip"].sum()),
+        "Stale.Onsets": int(stale.sum()),
+        "Error.Mean": np.mean(corrected[valid]) if valid.any() else np.nan,
+        "Error.P95": error_p95,
+        "Error.Max": abs_error.max() if abs_error.shape[0] > 0 else np.nan,
+        "Drift.Max": drift_max,
+        "Drift.Slope": (
+            np.nanmax(np.abs(slope)) * 60 if np.isfinite(slope).any() else np.nan
+        ),
+        "ITI.Target.Mean": target_mean,
+        "ITI.Mean": np.mean(realized_iti[iti_ok]) if iti_ok.any() else np.nan,
+        "ITI.Error.P95": (
+            np.percentile(np.abs(iti_error[iti_ok]), 95) if iti_ok.any() else np.nan
+        ),
+        "ITI.KS": ks,
+        "ITI.KS.Plan": ks_plan,
+        "ITI.KS.Real": ks_real,
+        "ITI.KS.Crit": ks_crit,
+        "Triggers": n_trig,
+        "TR": tr,
+        "TR.Jitter": jitter,
+        "Triggers.Missing": n_missing,
+        "Control.P95": (
+            np.percentile(control, 95) if control.shape[0] > 0 else np.nan
+        ),
+        "Status": "OK" if len(reasons) == 0 else "FLAG:" + "|".join(reasons),
+    }
+    return trials, summary
+
+
+def format_value(value):
+    if isinstance(value, (float, np.floating)):
+        return f"{value:.6f}"
+    return str(value)
+
+
+def main():
+    # Run parser
+    args = get_args()
+    with open(args.params) as fid:
+        params = json.load(fid)
+
+    # Check every session
+    summaries = []
+    trial_lines = []
+    for data_path in find_sessions(args.paths):
+        sess = load_session(data_path, params)
+        trials, summary = analyze(
+            sess, max_error=args.max_error, max_drift=args.max_drift, alpha=args.alpha
+        )
+        summaries.append(summary)
+        if args.trials is not None:
+            columns = [trials[key] for key in TRIAL_COLUMNS.split(",")[1:]]
+            for values in zip(*columns):
+                items = [sess.name] + [format_value(value) for value in values]
+                trial_lines.append(",".join(items) + "\n")
+
+        # Print short report
+        print(f"{summary['Session']} ({summary['Source']}): {summary['Status']}")
+        print(
+            f"   trials {summary['Trials.Run']}/{summary['Trials.Planned']}, "
+            f"pauses {summary['Pauses']} ({summary['Pause.Time']:.2f} s), "
+            f"skips {summary['Skips']}, stale onsets {summary['Stale.Onsets']}"
+        )
+        print(
+            f"   onset error mean {summary['Error.Mean'] * 1e3:.1f} ms, "
+            f"p95 {summary['Error.P95'] * 1e3:.1f} ms, "
+            f"max drift {summary['Drift.Max'] * 1e3:.1f} ms "
+            f"({summary['Drift.Slope'] * 1e3:.2f} ms/min)"
+        )
+        print(
+            f"   iti mean {summary['ITI.Mean']:.3f} s (target "
+            f"{summary['ITI.Target.Mean']:.3f}), KS vs target "
+            f"{summary['ITI.KS']:.3f} (plan {summary['ITI.KS.Plan']:.3f}), "
+            f"KS vs plan {summary['ITI.KS.Real']:.3f} "
+            f"(crit {summary['ITI.KS.Crit']:.3f})"
+        )
+        print(
+            f"   triggers {summary['Triggers']}, TR {summary['TR']:.3f} s, "
+            f"jitter {summary['TR.Jitter'] * 1e3:.1f} ms, "
+            f"missing {summary['Triggers.Missing']}"
+        )
+
+    # Save results
+    if args.out is not None:
+        with open(args.out, "w") as fid:
+            fid.write(SUMMARY_COLUMNS + "\n")
+            for summary in summaries:
+                items = [summary[key] for key in SUMMARY_COLUMNS.split(",")]
+                fid.write(",".join(format_value(item) for item in items) + "\n")
+    if args.trials is not None:
+        with open(args.trials, "w") as fid:
+            fid.write(TRIAL_COLUMNS + "\n")
+            fid.writelines(trial_lines)
+
+    # Non-zero exit so analysis pipelines can stop on flagged sessions
+    if any(summary["Status"] != "OK" for summary in summaries):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
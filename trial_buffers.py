@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+"""
+Preallocated trial and key-event buffers for the task loop
+
+Everything is allocated once before the first scan. During a scan the loop
+only writes into these arrays. Rows are formatted as text when a scan block
+ends, which is outside stimulus timing.
+"""
+
+# Load libraries
+import numpy as np
+
+# Letters of the experimenter's skip/pause commands, one bit each
+LETTER_BITS = {letter: 1 << i for i, letter in enumerate("skipaue")}
+SKIP_MASK = sum(LETTER_BITS[letter] for letter in "skip")
+PAUSE_MASK = sum(LETTER_BITS[letter] for letter in "pause")
+
+
+class KeyBuffer:
+    """
+    Ring buffer of timestamped key events with incremental command detection
+
+    Trigger keys go to their own ring. Every other key is stored with the
+    trial it was pressed in. While a trial runs, the buffer keeps track of the
+    number of button presses and of which skip/pause letters were seen, so no
+    scan over the trial's keys is needed when it ends.
+
+    Parameters
+    ----------
+    capacity : int
+       Number of key events held before the oldest are overwritten. Keys only
+       need to survive until the end of their scan block.
+    button : str
+       Response button key
+    trig : str
+       Scanner trigger key
+    key_len : int
+       Maximum key name length
+    """
+
+    def __init__(self, capacity, button, trig, key_len=16):
+        self.capacity = capacity
+        self.button = button
+        self.trig = trig
+        self.keys = np.zeros(
+            capacity, dtype=[("key", f"U{key_len}"), ("time", "f8"), ("trial", "i4")]
+        )
+        self.trigs = np.zeros(capacity, dtype=[("time", "f8"), ("scan", "i4")])
+        self.head = 0
+        self.n_trig = 0
+        self.trial = 0
+        self.n_button = 0
+        self.mask = 0
+
+    def start_trial(self, trial):
+        """
+        Resets the per-trial detector and returns the position of the trial's
+        first key
+        """
+        self.trial = trial
+        self.n_button = 0
+        self.mask = 0
+        return self.head
+
+    def add(self, key, time, scan, log=True):
+        """
+        Adds a key event. Non-trigger keys are only kept if log is True.
+        """
+        if key == self.trig:
+            self.trigs[self.n_trig % self.capacity] = (time, scan)
+            self.n_trig += 1
+        elif log is True:
+            self.keys[self.head % self.capacity] = (key, time, self.trial)
+            self.head += 1
+            self.mask |= LETTER_BITS.get(key, 0)
+            if key == self.button:
+                self.n_button += 1
+
+    @property
+    def skip(self):
+        return self.mask & SKIP_MASK == SKIP_MASK
+
+    @property
+    def pause(self):
+        return self.mask & PAUSE_MASK == PAUSE_MASK
+
+    def n_lost(self, start):
+        """
+        Number of keys since start that have already been overwritten
+        """
+        return max(0, self.head - self.capacity - start)
+
+    def format_keys(self, start, stop):
+        """
+        Returns the Key.List and Key.Bool strings for keys [start, stop)
+        """
+        start = max(start, self.head - self.capacity)
+        key_strs = []
+        bool_strs = []
+        for pos in range(start, stop):
+            key, time, _ = self.keys[pos % self.capacity]
+            key_strs.append(f"[{str(key)!r}, {float(time)!r}]")
+            bool_strs.append(str(key == self.button))
+        return "[" + ", ".join(key_strs) + "]", "[" + ", ".join(bool_strs) + "]"
+
+    def format_trigs(self, start, stop):
+        """
+        Returns csv rows (Scan,Time) for triggers [start, stop)
+        """
+        start = max(start, self.n_trig - self.capacity)
+        rows = []
+        for pos in range(start, stop):
+            time, scan = self.trigs[pos % self.capacity]
+            rows.append(f"{scan},{time:.6f}\n")
+        return rows
+
+
+class TrialBuffer:
+    """
+    Fixed-size table of trial records for a whole session
+
+    Parameters
+    ----------
+    n_trial : int
+       Number of trials in the session
+    stem_len : int
+       Maximum word stem length
+    """
+
+    def __init__(self, n_trial, stem_len=8):
+        self.rows = np.zeros(
+            n_trial,
+            dtype=[
+                ("scan", "i4"),
+                ("scan_start", "f8"),
+                ("trial", "i4"),
+                ("stem", f"U{stem_len}"),
+                ("onset", "f8"),
+                ("end", "f8"),
+                ("rec_start", "f8"),
+                ("key_start", "i8"),
+                ("key_stop", "i8"),
+            ],
+        )
+
+    def add(self, trial, scan, scan_start, stem, onset, end, rec_start, keys):
+        """
+        Stores a finished trial. keys is the (start, stop) position of its key
+        events in the KeyBuffer, and rec_start is nan when not recording.
+        """
+        self.rows[trial] = (
+            scan,
+            scan_start,
+            trial,
+            stem,
+            onset,
+            end,
+            rec_start,
+            keys[0],
+            keys[1],
+        )
+
+    def format_rows(self, start, stop, key_buf, word=True):
+        """
+        Returns data file lines for trials [start, stop), in the same format
+        the task has always written
+        """
+        lines = []
+        for row in self.rows[start:stop]:
+            key_list, key_bool = key_buf.format_keys(row["key_start"], row["key_stop"])
+            items = [
+                str(row["scan"]),
+                str(round(float(row["scan_start"]), 6)),
+                str(row["trial"]),
+            ]
+            if word is True:
+                items.append(str(row["stem"]))
+            items += [
+                str(round(float(row["onset"]), 6)),
+                str(round(float(row["end"]), 6)),
+                key_list,
+                key_bool,
+            ]
+            if word is True:
+                rec_start = float(row["rec_start"])
+                items.append("N/A" if np.isnan(rec_start) else str(rec_start))
+            lines.append(",".join(items) + "\n")
+        return lines